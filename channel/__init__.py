@@ -1,12 +1,50 @@
+import sys
+
 from .cache import (MessageCache, MemoryMessageCache,
                     OrderedMemoryMessageCache, RedisMessageCache,
                     OrderedRedisMessageCache)
 from .channel import Channel, JsonChannel, ReliableChannel
+from .codec import (Codec, JsonCodec, MsgpackCodec, CompressingCodec,
+                    register_codec)
+from .coalesce import Coalescer
+from .dispatch import KeyedExecutor
+from .cluster import Dispatcher, WorkerPool
+from .hub import ChannelHub
 from .dead import (DeadMessageBackend, MemoryDeadMessageBackend,
                    RedisDeadMessageBackend)
+from .flow import FlowWindow, WindowFull
+from .shard import HashRing
+from .presence import PresenceRegistry, Heartbeat
+from .history import (HistoryStore, MemoryHistoryStore, SqliteHistoryStore,
+                      RedisHistoryStore, HistoryClient, get_history_reply)
+from .retry import RetryScheduler, RedisRetryScheduler
+from .dedupe import (Deduplicator, WindowedDeduplicator, BloomDeduplicator,
+                     RedisDeduplicator)
 
 
 __all__ = ["MessageCache", "MemoryMessageCache", "OrderedMemoryMessageCache",
            "RedisMessageCache", "OrderedRedisMessageCache", "Channel",
            "JsonChannel", "ReliableChannel", "DeadMessageBackend",
-           "MemoryDeadMessageBackend", "RedisDeadMessageBackend"]
+           "MemoryDeadMessageBackend", "RedisDeadMessageBackend",
+           "Deduplicator", "WindowedDeduplicator", "BloomDeduplicator",
+           "RedisDeduplicator", "RetryScheduler", "RedisRetryScheduler",
+           "FlowWindow", "WindowFull", "KeyedExecutor",
+           "HashRing", "Dispatcher", "WorkerPool",
+           "PresenceRegistry", "Heartbeat", "HistoryStore",
+           "MemoryHistoryStore", "SqliteHistoryStore", "RedisHistoryStore",
+           "HistoryClient", "get_history_reply", "Codec", "JsonCodec",
+           "MsgpackCodec", "CompressingCodec", "register_codec", "Coalescer",
+           "ChannelHub"]
+
+if sys.version_info >= (3, 6):
+    from .aio import (AsyncMessageCache, AsyncMemoryMessageCache,
+                      AsyncRedisMessageCache, AsyncOrderedRedisMessageCache,
+                      AsyncRedisDeduplicator, AsyncRedisRetryScheduler,
+                      AsyncRedisDeadMessageBackend, AsyncChannel,
+                      AsyncJsonChannel, AsyncReliableChannel)
+
+    __all__ += ["AsyncMessageCache", "AsyncMemoryMessageCache",
+                "AsyncRedisMessageCache", "AsyncOrderedRedisMessageCache",
+                "AsyncRedisDeduplicator", "AsyncRedisRetryScheduler",
+                "AsyncRedisDeadMessageBackend", "AsyncChannel",
+                "AsyncJsonChannel", "AsyncReliableChannel"]
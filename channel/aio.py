@@ -0,0 +1,873 @@
+import asyncio
+import inspect
+import math
+import time
+
+import zmq
+import zmq.asyncio
+
+from .cache import (OrderedMemoryMessageCache, RedisMessageCache,
+                    OrderedRedisMessageCache)
+from .channel import Channel, JsonChannel, ReliableChannel
+from .coalesce import unpack
+from .codec import decode
+from .dead import RedisDeadMessageBackend
+from .dedupe import RedisDeduplicator
+from .flow import WindowFull
+from .retry import RetryScheduler, to_text
+
+
+async def resolve(value):
+    # lets callbacks and deduplicators be either plain or coroutines
+    if inspect.isawaitable(value):
+        return await value
+
+    return value
+
+
+class AsyncMessageCache(object):
+
+    async def get_unconfirmed_messages(self):
+        raise NotImplementedError()
+
+    async def get_received_syn_messages(self):
+        raise NotImplementedError()
+
+    async def store_message_to_send(self, message_id, message):
+        raise NotImplementedError()
+
+    async def confirm(self, message_id):
+        raise NotImplementedError()
+
+    async def is_unconfirmed(self, message_id):
+        raise NotImplementedError()
+
+    async def is_already_received(self, message_id):
+        raise NotImplementedError()
+
+    async def mark_as_received(self, message_id, message):
+        raise NotImplementedError()
+
+    async def iter_unconfirmed_messages(self, page_size=None):
+        for message in await self.get_unconfirmed_messages():
+            yield message
+
+    async def iter_received_syn_messages(self, page_size=None):
+        for message in await self.get_received_syn_messages():
+            yield message
+
+    async def get_sent_messages(self, message_ids):
+        message_ids = set(message_ids)
+        return [message for message in await self.get_unconfirmed_messages()
+                if message['headers']['message_id'] in message_ids]
+
+    async def discard(self, message_id):
+        await self.confirm(message_id)
+
+    async def confirm_many(self, message_ids):
+        for message_id in message_ids:
+            if await self.is_unconfirmed(message_id):
+                await self.confirm(message_id)
+
+    async def are_already_received(self, message_ids):
+        return [await self.is_already_received(message_id)
+                for message_id in message_ids]
+
+    async def mark_many_as_received(self, messages):
+        for message_id, message in messages:
+            await self.mark_as_received(message_id, message)
+
+
+class AsyncMemoryMessageCache(AsyncMessageCache):
+
+    def __init__(self, cache=None):
+        # memory caches never block so the async interface just wraps one
+        self.cache = cache if cache is not None else OrderedMemoryMessageCache()
+
+    async def get_unconfirmed_messages(self):
+        return self.cache.get_unconfirmed_messages()
+
+    async def get_received_syn_messages(self):
+        return self.cache.get_received_syn_messages()
+
+    async def iter_unconfirmed_messages(self, page_size=None):
+        for message in self.cache.iter_unconfirmed_messages(page_size):
+            yield message
+
+    async def iter_received_syn_messages(self, page_size=None):
+        for message in self.cache.iter_received_syn_messages(page_size):
+            yield message
+
+    async def get_sent_messages(self, message_ids):
+        return self.cache.get_sent_messages(message_ids)
+
+    async def store_message_to_send(self, message_id, message):
+        self.cache.store_message_to_send(message_id, message)
+
+    async def confirm(self, message_id):
+        self.cache.confirm(message_id)
+
+    async def discard(self, message_id):
+        self.cache.discard(message_id)
+
+    async def confirm_many(self, message_ids):
+        self.cache.confirm_many(message_ids)
+
+    async def is_unconfirmed(self, message_id):
+        return self.cache.is_unconfirmed(message_id)
+
+    async def is_already_received(self, message_id):
+        return self.cache.is_already_received(message_id)
+
+    async def are_already_received(self, message_ids):
+        return self.cache.are_already_received(message_ids)
+
+    async def mark_as_received(self, message_id, message):
+        self.cache.mark_as_received(message_id, message)
+
+    async def mark_many_as_received(self, messages):
+        self.cache.mark_many_as_received(messages)
+
+
+class AsyncRedisMessageCache(AsyncMessageCache, RedisMessageCache):
+
+    # same storage layout as RedisMessageCache on a redis.asyncio connection,
+    # the deduplicator may be a plain or an async one
+    async def get_unconfirmed_messages(self):
+        return self.load_syn_messages(await self.r.hvals(self.sent_name))
+
+    async def get_received_syn_messages(self):
+        return self.load_syn_messages(await self.r.hvals(self.received_name))
+
+    async def iter_hash_messages(self, name, page_size=None):
+        async for _, message in self.r.hscan_iter(name, count=page_size or self.page_size):
+            for message in self.load_syn_messages([message]):
+                yield message
+
+    def iter_unconfirmed_messages(self, page_size=None):
+        return self.iter_hash_messages(self.sent_name, page_size)
+
+    def iter_received_syn_messages(self, page_size=None):
+        return self.iter_hash_messages(self.received_name, page_size)
+
+    async def get_sent_messages(self, message_ids):
+        if not message_ids:
+            return []
+
+        return self.load_syn_messages(await self.r.hmget(self.sent_name, *message_ids))
+
+    async def store_message_to_send(self, message_id, message):
+        await self.r.hset(self.sent_name, message_id, self.serialize(message))
+
+    async def confirm(self, message_id):
+        await self.confirm_many([message_id])
+
+    async def confirm_many(self, message_ids):
+        if message_ids:
+            await self.r.hdel(self.sent_name, *message_ids)
+
+    async def is_unconfirmed(self, message_id):
+        return bool(await self.r.hexists(self.sent_name, message_id))
+
+    async def is_already_received(self, message_id):
+        return (await self.are_already_received([message_id]))[0]
+
+    async def are_already_received(self, message_ids):
+        pipe = self.r.pipeline(transaction=False)
+
+        for message_id in message_ids:
+            pipe.hexists(self.received_name, message_id)
+
+        received = [bool(exists) for exists in await pipe.execute()]
+
+        if not self.deduplicator:
+            return received
+
+        missing = [message_id for message_id, exists in zip(message_ids, received)
+                   if not exists]
+
+        if not missing:
+            return received
+
+        duplicates = await resolve(self.deduplicator.are_duplicates(missing))
+        duplicates = dict(zip(missing, duplicates))
+
+        return [exists or duplicates.get(message_id, False)
+                for message_id, exists in zip(message_ids, received)]
+
+    async def mark_as_received(self, message_id, message):
+        await self.mark_many_as_received([(message_id, message)])
+
+    async def mark_many_as_received(self, messages):
+        if not messages:
+            return
+
+        acknowledged = []
+        pipe = self.r.pipeline(transaction=True)
+
+        for message_id, message in messages:
+            forget = bool(self.deduplicator) and message['status'] != 'SYN'
+
+            if forget:
+                acknowledged.append(message_id)
+
+            self.queue_mark_as_received(pipe, message_id, message, forget)
+
+        await pipe.execute()
+
+        if acknowledged:
+            await resolve(self.deduplicator.add_many(acknowledged))
+
+
+class AsyncOrderedRedisMessageCache(AsyncRedisMessageCache, OrderedRedisMessageCache):
+
+    async def migrate(self, name):
+        if name in self.migrated:
+            return
+
+        legacy_name = self.get_legacy_name(name)
+
+        while True:
+            message_ids = await self.r.lrange(legacy_name, 0, self.page_size - 1)
+
+            if not message_ids:
+                break
+
+            scores = self.get_legacy_scores(message_ids,
+                                            await self.r.hmget(name, *message_ids))
+
+            pipe = self.r.pipeline(transaction=True)
+            if scores:
+                pipe.zadd(self.get_index_name(name), scores, nx=True)
+            pipe.ltrim(legacy_name, len(message_ids), -1)
+            await pipe.execute()
+
+        self.migrated.add(name)
+
+    async def get_indexed_messages(self, name):
+        await self.migrate(name)
+        message_ids = await self.r.zrange(self.get_index_name(name), 0, -1)
+
+        if not message_ids:
+            return []
+
+        return self.load_syn_messages(await self.r.hmget(name, *message_ids))
+
+    async def iter_indexed_messages(self, name, page_size=None):
+        await self.migrate(name)
+        page_size = page_size or self.page_size
+        index_name = self.get_index_name(name)
+        minimum = '-inf'
+        seen = set()
+
+        while True:
+            page = await self.r.zrangebyscore(index_name, minimum, '+inf', start=0,
+                                              num=page_size + len(seen), withscores=True)
+            page = [(message_id, score) for message_id, score in page
+                    if message_id not in seen]
+
+            if not page:
+                return
+
+            messages = await self.r.hmget(name, *[message_id for message_id, _ in page])
+
+            for message in self.load_syn_messages(messages):
+                yield message
+
+            minimum, seen = self.get_next_page_start(page, minimum, seen)
+
+    async def get_unconfirmed_messages(self):
+        return await self.get_indexed_messages(self.sent_name)
+
+    async def get_received_syn_messages(self):
+        return await self.get_indexed_messages(self.received_name)
+
+    def iter_unconfirmed_messages(self, page_size=None):
+        return self.iter_indexed_messages(self.sent_name, page_size)
+
+    def iter_received_syn_messages(self, page_size=None):
+        return self.iter_indexed_messages(self.received_name, page_size)
+
+    async def store_message_to_send(self, message_id, message):
+        pipe = self.r.pipeline(transaction=True)
+        pipe.zadd(self.get_index_name(self.sent_name), {message_id: message['timestamp']})
+        pipe.hset(self.sent_name, message_id, self.serialize(message))
+        await pipe.execute()
+
+    async def confirm_many(self, message_ids):
+        if not message_ids:
+            return
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hdel(self.sent_name, *message_ids)
+        pipe.zrem(self.get_index_name(self.sent_name), *message_ids)
+        await pipe.execute()
+
+
+class AsyncRedisDeduplicator(RedisDeduplicator):
+
+    async def is_duplicate(self, message_id):
+        return bool(await self.r.exists(self.get_key(message_id)))
+
+    async def add(self, message_id):
+        await self.r.set(self.get_key(message_id), 1, ex=self.window)
+
+    async def are_duplicates(self, message_ids):
+        pipe = self.r.pipeline(transaction=False)
+
+        for message_id in message_ids:
+            pipe.exists(self.get_key(message_id))
+
+        return [bool(exists) for exists in await pipe.execute()]
+
+    async def add_many(self, message_ids):
+        pipe = self.r.pipeline(transaction=False)
+
+        for message_id in message_ids:
+            pipe.set(self.get_key(message_id), 1, ex=self.window)
+
+        await pipe.execute()
+
+
+class AsyncRedisRetryScheduler(RetryScheduler):
+
+    def __init__(self, redis_connection, name, **kwargs):
+        # deadlines are kept in memory like a RetryScheduler's, flush()
+        # writes what changed to the sorted set a RedisRetryScheduler uses
+        # and load() reads it back after a restart
+        super(AsyncRedisRetryScheduler, self).__init__(**kwargs)
+
+        self.r = redis_connection
+        self.name = name
+        self.attempts_name = name + "_attempts"
+        self.changed = set()
+
+    def schedule(self, message_id, deadline=None, attempts=0):
+        super(AsyncRedisRetryScheduler, self).schedule(message_id, deadline,
+                                                       attempts)
+        self.changed.add(message_id)
+
+    def cancel(self, message_id):
+        super(AsyncRedisRetryScheduler, self).cancel(message_id)
+        self.changed.add(message_id)
+
+    async def load(self):
+        entries = await self.r.zrange(self.name, 0, -1, withscores=True)
+
+        if not entries:
+            return
+
+        attempts = await self.r.hmget(self.attempts_name,
+                                      *[message_id for message_id, _ in entries])
+
+        for (message_id, deadline), attempt in zip(entries, attempts):
+            message_id = to_text(message_id)
+
+            if message_id not in self.scheduled:
+                super(AsyncRedisRetryScheduler, self).schedule(message_id, deadline,
+                                                               int(attempt or 0))
+
+    async def flush(self):
+        if not self.changed:
+            return
+
+        changed, self.changed = self.changed, set()
+        deadlines = {}
+        cancelled = []
+
+        pipe = self.r.pipeline(transaction=True)
+
+        for message_id in changed:
+            entry = self.scheduled.get(message_id)
+
+            if entry is None:
+                cancelled.append(message_id)
+                continue
+
+            deadlines[message_id] = entry[0]
+            pipe.hset(self.attempts_name, message_id, entry[1])
+
+        if deadlines:
+            pipe.zadd(self.name, deadlines)
+        if cancelled:
+            pipe.zrem(self.name, *cancelled)
+            pipe.hdel(self.attempts_name, *cancelled)
+
+        await pipe.execute()
+
+
+class AsyncRedisDeadMessageBackend(RedisDeadMessageBackend):
+
+    # same layout as RedisDeadMessageBackend on a redis.asyncio connection,
+    # store() only buffers and the channel flushes once per synchronize
+    def store(self, context, data, comment):
+        self.buffer.append(self.get_details(context, data, comment))
+
+    async def flush(self):
+        if not self.buffer:
+            return
+
+        buffer, self.buffer = self.buffer, []
+        pipe = self.r.pipeline(transaction=True)
+
+        for details in buffer:
+            pipe.hset(self.store_name, details["context"], self.codec.encode(details))
+            pipe.zadd(self.index_name, {details["context"]: details["timestamp"]})
+
+        await pipe.execute()
+
+        await self.evict()
+
+    async def evict(self, now=None):
+        expired = []
+
+        if self.ttl:
+            now = now or time.time()
+            expired.extend(await self.r.zrangebyscore(self.index_name, '-inf',
+                                                      now - self.ttl))
+
+        if self.max_size:
+            expired.extend(await self.r.zrange(self.index_name, 0,
+                                               -self.max_size - 1))
+
+        await self.remove_many(expired)
+
+    async def iter_messages(self, page_size=None):
+        await self.flush()
+
+        async for _, details in self.r.hscan_iter(self.store_name,
+                                                  count=page_size or self.batch_size):
+            yield decode(details)
+
+    async def select(self, select=None, limit=None, page_size=None):
+        selected = []
+
+        async for details in self.iter_messages(page_size):
+            if select is None or select(details):
+                selected.append(details)
+
+                if limit and len(selected) >= limit:
+                    break
+
+        return selected
+
+    async def remove_many(self, contexts):
+        if not contexts:
+            return
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hdel(self.store_name, *contexts)
+        pipe.zrem(self.index_name, *contexts)
+        await pipe.execute()
+
+
+class AsyncChannel(Channel):
+    poller_class = zmq.asyncio.Poller
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncChannel, self).__init__(*args, **kwargs)
+
+        # set by stop() to end the wait for messages, created once the
+        # channel runs so that it belongs to the running loop
+        self.stopping = None
+
+    def get_context(self):
+        # channels on one event loop share a context and its io thread
+        return zmq.asyncio.Context.instance()
+
+    async def pre_callback_many(self, messages):
+        return super(AsyncChannel, self).pre_callback_many(messages)
+
+    async def dispatch(self, messages):
+        # callbacks may be coroutine functions, they are awaited in order
+        for message in messages:
+            for callback in self.callbacks:
+                await resolve(callback(message))
+
+        if messages:
+            for callback in self.batch_callbacks:
+                await resolve(callback(messages))
+
+    async def receive(self):
+        for receiver in self.receivers:
+            try:
+                message = await receiver.recv_multipart(zmq.DONTWAIT, copy=False)
+                break
+            except zmq.Again:
+                continue
+        else:
+            return
+
+        await self.dispatch(await self.pre_callback_many([message]))
+
+    async def receive_many(self, max_messages=100, max_wait=0):
+        if not await self.poll(max_wait):
+            return 0
+
+        messages = []
+
+        for receiver in self.receivers:
+            while len(messages) < max_messages:
+                try:
+                    messages.append(await receiver.recv_multipart(zmq.DONTWAIT, copy=False))
+                except zmq.Again:
+                    break
+
+        await self.dispatch(await self.pre_callback_many(messages))
+
+        return len(messages)
+
+    async def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = max(0, int(math.ceil(timeout * 1000)))
+
+        polling = self.poller.poll(timeout)
+
+        if self.stopping is not None:
+            stopping = asyncio.ensure_future(self.stopping.wait())
+            await asyncio.wait([polling, stopping],
+                               return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+
+            if not polling.done():
+                polling.cancel()
+                return False
+
+        events = dict(await polling)
+        return any(events.get(receiver) == zmq.POLLIN
+                   for receiver in self.receivers)
+
+    async def run_once(self, timeout=None, max_messages=100):
+        await self.receive_many(max_messages, self.get_poll_timeout(timeout))
+
+    async def run_forever(self, timeout=None, max_messages=100):
+        # waiting for messages never blocks the loop and stop() ends it at
+        # once
+        self.running = True
+        self.stopping = asyncio.Event()
+
+        while self.running:
+            await self.run_once(timeout, max_messages)
+
+    def stop(self):
+        super(AsyncChannel, self).stop()
+
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def send(self, *args, **kwargs):
+        await super(AsyncChannel, self).send(*args, **kwargs)
+
+
+class AsyncJsonChannel(AsyncChannel, JsonChannel):
+
+    async def run_once(self, timeout=None, max_messages=100):
+        await super(AsyncJsonChannel, self).run_once(timeout, max_messages)
+        await self.send_due_envelopes()
+
+    async def send_due_envelopes(self, now=None):
+        for envelope in self.get_due_envelopes(now):
+            await self.send(*envelope)
+
+    async def flush_envelopes(self):
+        for envelope in self.get_due_envelopes(force=True):
+            await self.send(*envelope)
+
+    async def send(self, destination, message_data, extra_headers=None):
+        if self.is_coalesced(destination, extra_headers):
+            for envelope in self.coalesce(destination, message_data, extra_headers):
+                await self.send(*envelope)
+
+            return
+
+        await super(AsyncJsonChannel, self).send(destination, message_data,
+                                                 extra_headers)
+
+
+class AsyncReliableChannel(AsyncJsonChannel, ReliableChannel):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncReliableChannel, self).__init__(*args, **kwargs)
+
+        # plain caches are wrapped, they should not block for long
+        if not isinstance(self.message_cache, AsyncMessageCache):
+            self.message_cache = AsyncMemoryMessageCache(self.message_cache)
+
+        # events are created once the channel runs so that they belong to
+        # the running loop
+        self.wakeup = None
+        self.window_event = None
+        self.timer = None
+
+        # futures of the sends made by the synchronous protocol code,
+        # awaited by flush_sends()
+        self.sends = []
+
+    def wake(self):
+        # lets the timer task synchronize right away
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run_once(self, timeout=None, max_messages=100):
+        await self.receive_many(max_messages, self.get_poll_timeout(timeout))
+        await self.synchronize()
+
+    async def run_forever(self, timeout=None, max_messages=100):
+        # retransmits and acks are driven by a timer task sleeping until the
+        # next deadline, the receive loop only waits for messages
+        self.running = True
+        self.stopping = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        timer = self.timer = asyncio.ensure_future(self.run_timer())
+
+        try:
+            while self.running:
+                await self.receive_many(max_messages, timeout)
+        finally:
+            timer.cancel()
+            self.timer = None
+
+        # raises what stopped the timer, e.g. a failed send
+        if timer.done() and not timer.cancelled():
+            timer.result()
+
+    async def run_timer(self):
+        try:
+            while self.running:
+                self.wakeup.clear()
+                await self.synchronize()
+
+                deadline = self.get_next_deadline()
+                timeout = None
+
+                if deadline is not None:
+                    timeout = max(0, deadline - time.time())
+
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        super(AsyncReliableChannel, self).stop()
+        self.wake()
+
+    def transmit(self, destination, message_data, headers):
+        sent = super(AsyncReliableChannel, self).transmit(destination,
+                                                          message_data,
+                                                          headers)
+
+        if sent is not None:
+            self.sends.append(sent)
+
+        return sent
+
+    async def flush_sends(self):
+        # send errors are raised here instead of being lost
+        sends, self.sends = self.sends, []
+
+        if sends:
+            await asyncio.gather(*sends)
+
+    async def send_control(self, destination, message_type):
+        super(AsyncReliableChannel, self).send_control(destination, message_type)
+        await self.flush_sends()
+
+    async def load_unconfirmed_messages(self):
+        await resolve(self.retry_scheduler.load())
+        message_ids = []
+
+        async for message in self.message_cache.iter_unconfirmed_messages(self.page_size):
+            if message['headers']['message_id'] in self.window_ids:
+                continue
+
+            message_ids.append(message['headers']['message_id'])
+            self.restore_members(message)
+
+            if len(message_ids) >= self.page_size:
+                self.retry_scheduler.schedule_new(message_ids)
+                message_ids = []
+
+        self.retry_scheduler.schedule_new(message_ids)
+
+        self.loaded_unconfirmed = True
+
+    async def synchronize(self):
+        if not self.loaded_unconfirmed:
+            await self.load_unconfirmed_messages()
+
+        now = time.time()
+
+        await self.send_due_envelopes(now)
+        await self.replay_due_messages(now)
+        await self.resend_due_messages(now)
+        await self.store_acked_members()
+        await self.acknowledge_received_messages(now)
+        self.request_missing_messages(now)
+
+        await self.flush_sends()
+        await resolve(self.retry_scheduler.flush())
+        await resolve(self.dead_message_backend.flush())
+
+    async def replay_dead_messages(self, select=None, limit=None):
+        selected = await resolve(self.dead_message_backend.select(
+            self.get_replay_filter(select), limit, self.page_size))
+
+        self.queue_replays(selected)
+        self.wake()
+
+        return len(selected)
+
+    async def replay_due_messages(self, now):
+        replays = self.get_due_replays(now)
+
+        for details in replays:
+            message = self.prepare_replay(details['data'], now)
+            await self.message_cache.store_message_to_send(message['headers']['message_id'],
+                                                           message)
+            self.admit_replay(message)
+
+        await resolve(self.dead_message_backend.remove_many(self.forget_replays(replays)))
+
+    async def resend_due_messages(self, now):
+        due = self.retry_scheduler.get_due(now, self.page_size)
+        messages = await self.message_cache.get_sent_messages([message_id for message_id, _ in due])
+
+        for message_id in self.resend_messages(due, messages, now):
+            await self.message_cache.discard(message_id)
+
+    async def store_acked_members(self):
+        message_ids, self.acked_multicasts = list(self.acked_multicasts), set()
+
+        if not message_ids:
+            return
+
+        for message in await self.message_cache.get_sent_messages(message_ids):
+            message_id = message['headers']['message_id']
+
+            # checked again before every store, acks keep arriving meanwhile
+            if message_id in self.multicasts:
+                message['acked_members'] = self.get_acked_members(message_id)
+                await self.message_cache.store_message_to_send(message_id, message)
+
+    async def acknowledge_received_messages(self, now):
+        self.next_acknowledge = None
+        expired = []
+        pending = {}
+
+        async for message in self.message_cache.iter_received_syn_messages(self.page_size):
+            full = self.queue_acknowledgement(message, now, expired, pending)
+
+            if full:
+                await self.flush_acknowledgements(*full)
+
+        await self.message_cache.mark_many_as_received(expired)
+
+        for destination, batch in self.get_due_acknowledgements(pending, now):
+            await self.flush_acknowledgements(destination, batch)
+
+    async def flush_acknowledgements(self, destination, batch):
+        self.prepare_acknowledgements(destination, batch)
+        await self.message_cache.mark_many_as_received(batch)
+
+    async def wait_for_window(self, window, size):
+        # needs run_forever running in another task to receive the acks
+        if self.window_event is None:
+            self.window_event = asyncio.Event()
+
+        while not window.is_open(size):
+            self.window_event.clear()
+            await self.window_event.wait()
+
+    def release_windows(self, message_ids, now):
+        super(AsyncReliableChannel, self).release_windows(message_ids, now)
+
+        if self.window_event is not None:
+            self.window_event.set()
+
+    async def send_to_group(self, group, members, message_data, extra_headers=None):
+        if members:
+            await self.send(group, message_data, extra_headers, members)
+
+    async def send(self, destination, message_data, extra_headers=None, members=None):
+        if members is None and self.is_coalesced(destination, extra_headers):
+            for envelope in self.coalesce(destination, message_data, extra_headers):
+                await self.send(*envelope)
+
+            # the timer task sleeps until the new envelope's linger is up
+            self.wake()
+            return
+
+        window, size = self.get_window_and_size(destination, message_data)
+
+        if window is not None and not window.is_open(size):
+            if self.flow_control == 'error':
+                raise WindowFull(destination)
+
+            if self.flow_control == 'block':
+                await self.wait_for_window(window, size)
+
+        message_id, message_to_store = self.build_message(destination,
+                                                          message_data,
+                                                          extra_headers,
+                                                          members)
+
+        await self.message_cache.store_message_to_send(message_id, message_to_store)
+
+        self.admit_message(message_id, destination, window, size)
+        self.wake()
+
+    async def drop_destination(self, destination):
+        dropped = []
+        confirmed = []
+
+        async for message in self.message_cache.iter_unconfirmed_messages(self.page_size):
+            message_ids = self.get_dropped_ids(destination, message)
+
+            if message_ids is not None:
+                if self.is_catch_up(message):
+                    dropped.append(message)
+
+                confirmed.extend(message_ids)
+
+        await self.message_cache.confirm_many(confirmed)
+        self.handle_acknowledged(confirmed)
+
+        return dropped
+
+    async def pre_callback(self, message):
+        messages = await self.pre_callback_many([message])
+
+        if messages:
+            return messages[0]
+
+        return None
+
+    async def pre_callback_many(self, messages):
+        acknowledged, requested, received, control = self.sort_messages(messages)
+
+        if acknowledged:
+            await self.message_cache.confirm_many(acknowledged)
+            self.handle_acknowledged(acknowledged)
+
+        if requested:
+            self.retry_scheduler.retry_now(requested)
+            self.wake()
+
+        if not received:
+            return unpack(control)
+
+        message_ids = [message['headers']['message_id'] for message in received]
+        already_received = await self.message_cache.are_already_received(message_ids)
+
+        to_mark, to_callback = self.get_received_marks(received, already_received)
+
+        await self.message_cache.mark_many_as_received(to_mark)
+
+        # the acks go out from the timer task
+        self.wake()
+
+        return unpack(control + to_callback)
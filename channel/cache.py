@@ -1,7 +1,8 @@
-import json
-
 from collections import OrderedDict
 
+from .codec import JsonCodec, decode
+from .dedupe import WindowedDeduplicator
+
 
 class MessageCache(object):
 
@@ -26,123 +27,337 @@ class MessageCache(object):
     def mark_as_received(self, message_id, message):
         raise NotImplementedError()
 
+    def iter_unconfirmed_messages(self, page_size=None):
+        return iter(self.get_unconfirmed_messages())
+
+    def iter_received_syn_messages(self, page_size=None):
+        return iter(self.get_received_syn_messages())
+
+    def get_sent_messages(self, message_ids):
+        message_ids = set(message_ids)
+        return [message for message in self.get_unconfirmed_messages()
+                if message['headers']['message_id'] in message_ids]
+
+    def discard(self, message_id):
+        # stop tracking a message that will never be confirmed
+        self.confirm(message_id)
+
+    def confirm_many(self, message_ids):
+        for message_id in message_ids:
+            if self.is_unconfirmed(message_id):
+                self.confirm(message_id)
+
+    def are_already_received(self, message_ids):
+        return [self.is_already_received(message_id)
+                for message_id in message_ids]
+
+    def mark_many_as_received(self, messages):
+        for message_id, message in messages:
+            self.mark_as_received(message_id, message)
+
 
 class MemoryMessageCache(MessageCache):
+    index_class = dict
 
-    def __init__(self):
-        self.sent = {}
-        self.received = {}
+    def __init__(self, deduplicator=None):
+        # only pending messages are kept, acknowledged received messages
+        # are evicted and only remembered by the deduplicator
+        self.sent = self.index_class()
+        self.received = self.index_class()
+        self.deduplicator = deduplicator or WindowedDeduplicator()
 
     def get_unconfirmed_messages(self):
-        return [message for message in self.sent.values()
-                if message['status'] == 'SYN']
+        return list(self.sent.values())
 
     def get_received_syn_messages(self):
-        return [message for message in self.received.values()
-                if message['status'] == 'SYN']
+        return list(self.received.values())
+
+    def get_sent_messages(self, message_ids):
+        return [self.sent[message_id] for message_id in message_ids
+                if message_id in self.sent]
 
     def store_message_to_send(self, message_id, message):
         self.sent[message_id] = message
 
     def confirm(self, message_id):
-        self.sent[message_id]['status'] = 'ACK'
+        message = self.sent.pop(message_id, None)
+
+        if message is not None:
+            message['status'] = 'ACK'
 
     def is_unconfirmed(self, message_id):
-        return message_id in self.sent and self.sent[message_id]['status'] == 'SYN'
+        return message_id in self.sent
 
     def is_already_received(self, message_id):
-        return message_id in self.received
+        return (message_id in self.received
+                or self.deduplicator.is_duplicate(message_id))
 
     def mark_as_received(self, message_id, message):
-        self.received[message_id] = message
+        if message['status'] == 'SYN':
+            self.received[message_id] = message
+            return
 
+        self.received.pop(message_id, None)
+        self.deduplicator.add(message_id)
 
-class OrderedMemoryMessageCache(MemoryMessageCache):
 
-    def __init__(self):
-        self.sent = OrderedDict()
-        self.received = OrderedDict()
+class OrderedMemoryMessageCache(MemoryMessageCache):
+    index_class = OrderedDict
 
 
 class RedisMessageCache(MessageCache):
 
-    def __init__(self, redis_connection, sent_name, received_name):
+    def __init__(self, redis_connection, sent_name, received_name,
+                 deduplicator=None, page_size=500, codec=None):
         self.r = redis_connection
         self.sent_name = sent_name
         self.received_name = received_name
+        self.page_size = page_size
+
+        # without a deduplicator every received message is kept forever
+        # so that duplicates can be detected
+        self.deduplicator = deduplicator
+
+        # messages are written with codec and read with whichever codec
+        # wrote them, a CompressingCodec also compresses large ones
+        self.codec = codec or JsonCodec()
 
     def serialize(self, data):
-        return json.dumps(data)
+        return self.codec.encode(data)
 
     def unserialize(self, data):
-        return json.loads(data)
+        return decode(data)
 
-    def get_unconfirmed_messages(self):
-        messages = [self.unserialize(message) for message in self.r.hvals(self.sent_name)]
+    def load_syn_messages(self, messages):
+        # unserializes stored messages, skipping missing and confirmed ones
+        messages = [self.unserialize(message) for message in messages if message]
         return [message for message in messages if message['status'] == 'SYN']
 
+    def get_unconfirmed_messages(self):
+        return self.load_syn_messages(self.r.hvals(self.sent_name))
+
     def get_received_syn_messages(self):
-        messages = [self.unserialize(message) for message in self.r.hvals(self.received_name)]
-        return [message for message in messages if message['status'] == 'SYN']
+        return self.load_syn_messages(self.r.hvals(self.received_name))
+
+    def iter_hash_messages(self, name, page_size=None):
+        # HSCAN may return an entry more than once, which is harmless for
+        # retransmits and acks
+        for _, message in self.r.hscan_iter(name, count=page_size or self.page_size):
+            message = self.unserialize(message)
+            if message['status'] == 'SYN':
+                yield message
+
+    def iter_unconfirmed_messages(self, page_size=None):
+        return self.iter_hash_messages(self.sent_name, page_size)
+
+    def iter_received_syn_messages(self, page_size=None):
+        return self.iter_hash_messages(self.received_name, page_size)
+
+    def get_sent_messages(self, message_ids):
+        if not message_ids:
+            return []
+
+        return [self.unserialize(message) for message in self.r.hmget(self.sent_name, *message_ids)
+                if message]
 
     def store_message_to_send(self, message_id, message):
         self.r.hset(self.sent_name, message_id, self.serialize(message))
 
     def confirm(self, message_id):
-        message = self.unserialize(self.r.hget(self.sent_name, message_id))
-        message['status'] = 'ACK'
-        self.r.hset(self.sent_name, message_id, self.serialize(message))
+        # confirmed messages are never read again, dropping them is a
+        # single round trip and keeps the hash down to pending messages
+        self.confirm_many([message_id])
+
+    def confirm_many(self, message_ids):
+        if message_ids:
+            self.r.hdel(self.sent_name, *message_ids)
 
     def is_unconfirmed(self, message_id):
-        return self.r.hexists(self.sent_name, message_id) and self.unserialize(self.r.hget(self.sent_name, message_id))['status'] == 'SYN'
+        return self.r.hexists(self.sent_name, message_id)
 
     def is_already_received(self, message_id):
-        return self.r.hexists(self.received_name, message_id)
+        return self.are_already_received([message_id])[0]
+
+    def are_already_received(self, message_ids):
+        pipe = self.r.pipeline(transaction=False)
+
+        for message_id in message_ids:
+            pipe.hexists(self.received_name, message_id)
+
+        received = [bool(exists) for exists in pipe.execute()]
+
+        if not self.deduplicator:
+            return received
+
+        missing = [message_id for message_id, exists in zip(message_ids, received)
+                   if not exists]
+
+        if not missing:
+            return received
+
+        duplicates = dict(zip(missing, self.deduplicator.are_duplicates(missing)))
+
+        return [exists or duplicates.get(message_id, False)
+                for message_id, exists in zip(message_ids, received)]
 
     def mark_as_received(self, message_id, message):
-        self.r.hset(self.received_name, message_id, self.serialize(message))
+        self.mark_many_as_received([(message_id, message)])
+
+    def mark_many_as_received(self, messages):
+        if not messages:
+            return
+
+        acknowledged = []
+        pipe = self.r.pipeline(transaction=True)
+
+        for message_id, message in messages:
+            forget = bool(self.deduplicator) and message['status'] != 'SYN'
+
+            if forget:
+                acknowledged.append(message_id)
+
+            self.queue_mark_as_received(pipe, message_id, message, forget)
+
+        pipe.execute()
+
+        if acknowledged:
+            self.deduplicator.add_many(acknowledged)
+
+    def queue_mark_as_received(self, pipe, message_id, message, forget):
+        if forget:
+            pipe.hdel(self.received_name, message_id)
+        else:
+            pipe.hset(self.received_name, message_id, self.serialize(message))
 
 
 class OrderedRedisMessageCache(RedisMessageCache):
 
-    def get_unconfirmed_messages(self):
-        key_list = self.sent_name + "_keys"
-        message_ids = self.r.lrange(key_list, 0, self.r.llen(key_list))
+    def __init__(self, *args, **kwargs):
+        super(OrderedRedisMessageCache, self).__init__(*args, **kwargs)
+
+        self.migrated = set()
+
+    # pending message ids are kept in sorted sets scored by timestamp
+    def get_index_name(self, name):
+        return name + "_index"
+
+    def get_legacy_name(self, name):
+        # caches written before the sorted sets kept ids in lists
+        return name + "_keys"
+
+    def get_legacy_scores(self, message_ids, messages):
+        scores = {}
+
+        for message_id, message in zip(message_ids, messages):
+            if message:
+                scores[message_id] = self.unserialize(message)['timestamp']
+
+        return scores
+
+    def migrate(self, name):
+        # moves the ids of a list left by an older version to the index the
+        # first time name is read, a page at a time
+        if name in self.migrated:
+            return
+
+        legacy_name = self.get_legacy_name(name)
+
+        while True:
+            message_ids = self.r.lrange(legacy_name, 0, self.page_size - 1)
+
+            if not message_ids:
+                break
+
+            scores = self.get_legacy_scores(message_ids,
+                                            self.r.hmget(name, *message_ids))
+
+            pipe = self.r.pipeline(transaction=True)
+            if scores:
+                pipe.zadd(self.get_index_name(name), scores, nx=True)
+            pipe.ltrim(legacy_name, len(message_ids), -1)
+            pipe.execute()
+
+        self.migrated.add(name)
+
+    def get_indexed_messages(self, name):
+        self.migrate(name)
+        message_ids = self.r.zrange(self.get_index_name(name), 0, -1)
 
         if not message_ids:
             return []
 
-        messages = [self.unserialize(message) for message in self.r.hmget(self.sent_name, *message_ids) if message]
-        return [message for message in messages if message['status'] == 'SYN']
+        return self.load_syn_messages(self.r.hmget(name, *message_ids))
+
+    def iter_indexed_messages(self, name, page_size=None):
+        # pages by score rather than by offset so that messages confirmed
+        # while iterating don't shift the pages, ids already seen at the
+        # last score of a page are skipped on the next one
+        self.migrate(name)
+        page_size = page_size or self.page_size
+        index_name = self.get_index_name(name)
+        minimum = '-inf'
+        seen = set()
+
+        while True:
+            page = self.r.zrangebyscore(index_name, minimum, '+inf', start=0,
+                                        num=page_size + len(seen), withscores=True)
+            page = [(message_id, score) for message_id, score in page
+                    if message_id not in seen]
+
+            if not page:
+                return
+
+            messages = self.r.hmget(name, *[message_id for message_id, _ in page])
+
+            for message in self.load_syn_messages(messages):
+                yield message
+
+            minimum, seen = self.get_next_page_start(page, minimum, seen)
+
+    def get_next_page_start(self, page, minimum, seen):
+        last_score = page[-1][1]
+
+        if last_score != minimum:
+            seen = set()
+
+        seen.update(message_id for message_id, score in page if score == last_score)
+
+        return last_score, seen
+
+    def get_unconfirmed_messages(self):
+        return self.get_indexed_messages(self.sent_name)
 
     def get_received_syn_messages(self):
-        key_list = self.received_name + "_keys"
-        message_ids = self.r.lrange(key_list, 0, self.r.llen(key_list))
+        return self.get_indexed_messages(self.received_name)
 
-        if not message_ids:
-            return []
+    def iter_unconfirmed_messages(self, page_size=None):
+        return self.iter_indexed_messages(self.sent_name, page_size)
 
-        messages = [self.unserialize(message) for message in self.r.hmget(self.received_name, *message_ids) if message]
-        return [message for message in messages if message['status'] == 'SYN']
+    def iter_received_syn_messages(self, page_size=None):
+        return self.iter_indexed_messages(self.received_name, page_size)
 
     def store_message_to_send(self, message_id, message):
-        key_list = self.sent_name + "_keys"
-        self.r.rpush(key_list, message_id)
+        pipe = self.r.pipeline(transaction=True)
+        pipe.zadd(self.get_index_name(self.sent_name), {message_id: message['timestamp']})
+        pipe.hset(self.sent_name, message_id, self.serialize(message))
+        pipe.execute()
 
-        super(OrderedRedisMessageCache, self).store_message_to_send(message_id, message)
-
-    def confirm(self, message_id):
-        super(OrderedRedisMessageCache, self).confirm(message_id)
-        key_list = self.sent_name + "_keys"
-        self.r.lrem(key_list, 0, message_id)
+    def confirm_many(self, message_ids):
+        if not message_ids:
+            return
 
-    def mark_as_received(self, message_id, message):
-        key_list = self.received_name + "_keys"
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hdel(self.sent_name, *message_ids)
+        pipe.zrem(self.get_index_name(self.sent_name), *message_ids)
+        pipe.execute()
 
-        if not self.is_already_received(message_id):
-            self.r.rpush(key_list, message_id)
+    def queue_mark_as_received(self, pipe, message_id, message, forget):
+        index_name = self.get_index_name(self.received_name)
 
-        if message['status'] == 'ACK':
-            self.r.lrem(key_list, 0, message_id)
+        if message['status'] == 'SYN':
+            # nx keeps the original position of re-received messages
+            pipe.zadd(index_name, {message_id: message['timestamp']}, nx=True)
+        else:
+            pipe.zrem(index_name, message_id)
 
-        super(OrderedRedisMessageCache, self).mark_as_received(message_id, message)
+        super(OrderedRedisMessageCache, self).queue_mark_as_received(pipe, message_id, message, forget)
@@ -1,63 +1,399 @@
 import zmq
-import json
+import math
 import uuid
 import time
+import logging
+import threading
+
+from collections import OrderedDict, deque
 
 from .cache import OrderedMemoryMessageCache
+from .codec import JsonCodec, LazyMessage, compress, get_codec
+from .coalesce import unpack
 from .dead import MemoryDeadMessageBackend
+from .retry import RetryScheduler
+from .session import SequenceTracker
+from .flow import FlowWindow, WindowFull
+from .shard import ShardSockets
+
+logger = logging.getLogger(__name__)
 
 
 class Channel(object):
+    poller_class = zmq.Poller
 
-    def __init__(self, identity, publish_to, receive_from):
+    def __init__(self, identity, publish_to, receive_from, hub=None):
         self.identity = identity
-        self.context = zmq.Context()
-        self.sender = self.context.socket(zmq.PUB)
-        self.receiver = self.context.socket(zmq.SUB)
+        self.groups = set()
+
+        # channels created by a ChannelHub share its context, sockets,
+        # shards and lock and are run by it
+        self.hub = hub
+
+        if hub is not None:
+            self.sockets = hub.sockets
+        else:
+            # publish_to and receive_from may be lists of router shards, the
+            # shard owning an identity is picked by consistent hashing over
+            # the publish locations so every peer must list them the same way
+            self.sockets = ShardSockets(self.get_context(), publish_to,
+                                        receive_from)
+
+        self.context = self.sockets.context
+        self.receiver = self.sockets.receiver
+        self.shards = self.sockets.shards
+        self.ring = self.sockets.ring
+        self.senders = self.sockets.senders
+        self.sender = self.sockets.get_first_sender()
+
+        self.connect_receiver()
 
-        self.sender.connect(publish_to)
-        self.receiver.connect(receive_from)
-        subscription = identity + "::"
-        subscription = subscription.encode("ascii")
-        self.receiver.setsockopt(zmq.SUBSCRIBE, subscription)
+        self.poller = self.poller_class()
+        self.receivers = []
+
+        if hub is None:
+            self.poller.register(self.receiver, zmq.POLLIN)
+            self.receivers.append(self.receiver)
 
         self.callbacks = []
+        self.batch_callbacks = []
+        self.running = False
+
+        # callbacks run inline unless an executor is set, the lock keeps
+        # sends from callbacks apart from the receiving thread
+        self.executor = None
+        self.lock = hub.lock if hub is not None else threading.RLock()
+
+        # pair of sockets other threads wake the receiving thread with, made
+        # once an executor is set
+        self.wake_sender = None
+        self.wake_receiver = None
+
+        self.subscribe(identity + "::")
+
+    def get_context(self):
+        return zmq.Context()
+
+    @property
+    def receive_from(self):
+        return self.sockets.receive_from
+
+    def connect_receiver(self):
+        # subscribes on the shards that own this identity and its groups,
+        # a hub's receiver is connected to every shard
+        if self.hub is not None:
+            return
+
+        self.sockets.connect_receiver(set(
+            self.sockets.get_owner(name)
+            for name in [self.identity] + list(self.groups)))
+
+    def add_receiver(self, receive_from, socket_type=zmq.PULL):
+        # extra socket the channel reads from, e.g. a dispatcher handing it
+        # messages already addressed to this identity
+        receiver = self.context.socket(socket_type)
+        receiver.connect(receive_from)
+
+        self.poller.register(receiver, zmq.POLLIN)
+        self.receivers.append(receiver)
+
+        return receiver
+
+    def subscribe(self, topic):
+        if self.hub is not None:
+            self.hub.subscribe(topic, self)
+        else:
+            self.receiver.setsockopt(zmq.SUBSCRIBE, topic.encode("utf-8"))
+
+    def unsubscribe(self, topic):
+        if self.hub is not None:
+            self.hub.unsubscribe(topic, self)
+        else:
+            self.receiver.setsockopt(zmq.UNSUBSCRIBE, topic.encode("utf-8"))
+
+    def join(self, group):
+        # messages sent to the group are received like direct ones
+        self.groups.add(group)
+        self.connect_receiver()
+        self.subscribe(group + "::")
+
+    def leave(self, group):
+        if group not in self.groups:
+            return
+
+        self.groups.remove(group)
+        self.unsubscribe(group + "::")
+        self.connect_receiver()
+
+    def add_shard(self, publish_to, receive_from):
+        if self.hub is not None:
+            return self.hub.add_shard(publish_to, receive_from)
+
+        self.sockets.add_shard(publish_to, receive_from)
+        self.connect_receiver()
+
+    def remove_shard(self, publish_to):
+        if self.hub is not None:
+            return self.hub.remove_shard(publish_to)
+
+        self.sockets.remove_shard(publish_to)
+
+        if self.shards:
+            self.sender = self.sockets.get_first_sender()
+
+        self.connect_receiver()
+
+    def get_sender(self, destination):
+        return self.senders[self.ring.get_node(destination)]
 
     def register_callback(self, callback):
         self.callbacks.append(callback)
 
-    def pre_callback(self, message):
-        # strip the identity
+    def register_batch_callback(self, callback):
+        self.batch_callbacks.append(callback)
+
+    def set_executor(self, executor):
+        # e.g. a KeyedExecutor, messages with the same dispatch key are
+        # handed to it in order
+        self.executor = executor
+
+        if self.hub is None and self.wake_receiver is None:
+            address = "inproc://wake-" + uuid.uuid4().hex
+
+            self.wake_receiver = self.context.socket(zmq.PAIR)
+            self.wake_receiver.bind(address)
+            self.wake_sender = self.context.socket(zmq.PAIR)
+            self.wake_sender.connect(address)
+
+            self.poller.register(self.wake_receiver, zmq.POLLIN)
+
+    def wake(self):
+        # lets the receiving thread pick up what another thread scheduled
+        # instead of sleeping until the next message arrives
+        if self.hub is not None:
+            self.hub.wake(self)
+            return
+
+        if self.wake_sender is None:
+            return
+
+        with self.lock:
+            try:
+                self.wake_sender.send(b"", zmq.DONTWAIT)
+            except zmq.Again:
+                # the receiving thread has wake ups waiting already
+                pass
+
+    def drain_wakes(self):
+        while True:
+            try:
+                self.wake_receiver.recv(zmq.DONTWAIT)
+            except zmq.Again:
+                return
+
+    def get_dispatch_key(self, message):
+        return None
+
+    def get_body(self, message):
+        # strip the identity or group
+        for group in self.groups:
+            prefix = (group + "::").encode("utf-8")
+
+            if message.startswith(prefix):
+                return message[len(prefix):]
+
         return message[len(self.identity) + 2:]  # +2 for ::
 
-    def receive(self):
-        try:
-            message = self.receiver.recv_string(zmq.DONTWAIT)
+    def pre_callback(self, frames):
+        # messages are lists of frames, the topic frame of multipart ones is
+        # dropped
+        if len(frames) > 1:
+            return [frame.bytes for frame in frames[1:]]
+
+        return self.get_body(frames[0].bytes).decode("utf-8")
+
+    def pre_callback_many(self, messages):
+        processed = []
+
+        for message in messages:
+            message = self.pre_callback(message)
+            if message:
+                processed.append(message)
+
+        return processed
+
+    def dispatch(self, messages):
+        if self.executor is None:
+            self.run_callbacks(messages)
+            return
+
+        # batch callbacks get one batch per key
+        batches = OrderedDict()
+
+        for message in messages:
+            batches.setdefault(self.get_dispatch_key(message), []).append(message)
+
+        for key, batch in batches.items():
+            self.executor.submit(key, self.run_callbacks, batch)
+
+    def run_callbacks(self, messages):
+        for message in messages:
             for callback in self.callbacks:
-                message = self.pre_callback(message)
-                if message:
-                    callback(message)
-        except zmq.Again:
-            pass
+                callback(message)
+
+        if messages:
+            for callback in self.batch_callbacks:
+                callback(messages)
+
+    def receive(self):
+        for receiver in self.receivers:
+            try:
+                message = receiver.recv_multipart(zmq.DONTWAIT, copy=False)
+                break
+            except zmq.Again:
+                continue
+        else:
+            return
+
+        self.handle([message])
+
+    def receive_many(self, max_messages=100, max_wait=0):
+        if not self.poll(max_wait):
+            return 0
+
+        messages = []
+
+        for receiver in self.receivers:
+            while len(messages) < max_messages:
+                try:
+                    messages.append(receiver.recv_multipart(zmq.DONTWAIT, copy=False))
+                except zmq.Again:
+                    break
+
+        self.handle(messages)
+
+        return len(messages)
+
+    def handle(self, messages):
+        # messages received for this channel, e.g. by a hub
+        with self.lock:
+            processed = self.pre_callback_many(messages)
+
+        self.dispatch(processed)
+
+    def poll(self, timeout=None):
+        # timeout is in seconds, None blocks until something arrives, it is
+        # rounded up so that deadlines have passed on waking
+        if timeout is not None:
+            timeout = max(0, int(math.ceil(timeout * 1000)))
+
+        events = dict(self.poller.poll(timeout))
+
+        if self.wake_receiver is not None and events.get(self.wake_receiver) == zmq.POLLIN:
+            self.drain_wakes()
+
+        return any(events.get(receiver) == zmq.POLLIN
+                   for receiver in self.receivers)
+
+    def get_next_deadline(self):
+        # when run_due() next has something to do, None if nothing is pending
+        return None
+
+    def get_poll_timeout(self, timeout=None):
+        # wake up in time for whatever is due next, deadlines are read under
+        # the lock since senders on other threads reschedule messages
+        with self.lock:
+            deadline = self.get_next_deadline()
+
+        if deadline is None:
+            return timeout
+
+        due = max(0, deadline - time.time())
+
+        if timeout is None:
+            return due
+
+        return min(timeout, due)
+
+    def run_due(self):
+        pass
+
+    def run_once(self, timeout=None, max_messages=100):
+        timeout = self.get_poll_timeout(timeout)
+
+        if self.poll(timeout):
+            self.receive_many(max_messages)
+
+        self.run_due()
+
+    def run_forever(self, timeout=None, max_messages=100):
+        self.running = True
+
+        while self.running:
+            self.run_once(timeout, max_messages)
+
+    def stop(self):
+        self.running = False
 
     def send(self, destination, message):
-        actual = "{}::{}".format(destination, message)
-        self.sender.send_string(actual)
+        # message is already encoded bytes or anything that formats as text
+        if not isinstance(message, bytes):
+            message = u"{}".format(message).encode("utf-8")
+
+        actual = (destination + "::").encode("utf-8") + message
+
+        with self.lock:
+            return self.get_sender(destination).send(actual)
+
+    def send_multipart(self, destination, frames):
+        # a topic frame followed by frames that are sent without copying
+        topic = (destination + "::").encode("utf-8")
+
+        with self.lock:
+            return self.get_sender(destination).send_multipart([topic] + frames,
+                                                               copy=False)
 
 
 class JsonChannel(Channel):
 
     def __init__(self, *args, **kwargs):
+        default_headers = kwargs.pop('default_headers', None)
+        # the codec messages are sent with, peers that haven't shown they
+        # can read it are sent JSON instead
+        self.codec = kwargs.pop('codec', None) or JsonCodec()
+        # headers and data go in frames of their own to peers that listed
+        # multipart in accept, False always sends single frames
+        self.multipart = kwargs.pop('multipart', True)
+        # payloads bigger than compress_threshold bytes are sent compressed
+        # to peers that listed zlib in accept, 0 disables compression
+        self.compress_threshold = int(kwargs.pop('compress_threshold', 0))
+        self.compress_level = int(kwargs.pop('compress_level', 6))
+        # e.g. a Coalescer packing messages for the same destination into
+        # envelopes, None sends every message on its own
+        self.coalescer = kwargs.pop('coalescer', None)
+        self.json_codec = JsonCodec()
+        self.peer_codecs = {}
+        # what peers listed in their accept header, and the peers that
+        # showed they read ours
+        self.peer_accepts = {}
+        self.informed_peers = set()
+
         super(JsonChannel, self).__init__(*args, **kwargs)
 
         self.default_headers = {
             'source': self.identity
         }
 
-        if 'default_headers' in kwargs:
-            self.default_headers.update(kwargs['default_headers'])
+        if default_headers:
+            self.default_headers.update(default_headers)
 
     def send(self, destination, message_data, extra_headers=None):
+        if self.is_coalesced(destination, extra_headers):
+            for envelope in self.coalesce(destination, message_data, extra_headers):
+                self.send(*envelope)
+
+            return None
+
         headers = {
             "destination": destination,
         }
@@ -68,16 +404,174 @@ class JsonChannel(Channel):
         if extra_headers:
             headers.update(extra_headers)
 
-        actual_message = {
-            "headers": headers,
-            "data": message_data
-        }
+        codec = self.get_codec(destination)
+        accept = self.get_accept()
 
-        super(JsonChannel, self).send(destination, json.dumps(actual_message))
+        if accept and destination not in self.informed_peers:
+            headers['accept'] = accept
 
-    def pre_callback(self, message):
-        message = super(JsonChannel, self).pre_callback(message)
-        return json.loads(message)
+        if self.multipart and self.accepts(destination, 'multipart'):
+            payload, compressed = self.encode_payload(destination, codec,
+                                                      message_data, headers)
+
+            if compressed:
+                headers['encoding'] = 'zlib'
+
+            return self.send_multipart(destination, [codec.encode(headers),
+                                                     payload])
+
+        # headers first so that e.g. a Dispatcher can read them alone
+        actual_message = OrderedDict([
+            ("headers", headers),
+            ("data", message_data)
+        ])
+
+        return super(JsonChannel, self).send(destination, codec.encode(actual_message))
+
+    def should_compress(self, destination):
+        return bool(self.compress_threshold) and self.accepts(destination, 'zlib')
+
+    def encode_payload(self, destination, codec, message_data, headers):
+        # returns the payload frame and whether it is compressed
+        payload = codec.encode(message_data)
+
+        if not self.should_compress(destination):
+            return payload, False
+
+        compressed = compress(payload, self.compress_threshold,
+                              self.compress_level)
+
+        return compressed, compressed is not payload
+
+    def is_coalesced(self, destination, extra_headers):
+        # acks, control messages, retransmits and envelopes go out on their
+        # own and can overtake messages waiting in an envelope, peers that
+        # haven't listed batch, e.g. group topics, get every message alone
+        if self.coalescer is None or not self.accepts(destination, 'batch'):
+            return False
+
+        return not extra_headers or not any(key in extra_headers for key in
+                                            ('type', 'message_id', 'batch'))
+
+    def coalesce(self, destination, message_data, extra_headers=None):
+        # returns the (destination, items, headers) envelopes to send now
+        size = 0
+
+        if self.coalescer.max_bytes:
+            size = len(self.codec.encode(message_data))
+
+        with self.lock:
+            items = self.coalescer.add(destination, message_data,
+                                       extra_headers, size)
+
+        if items is None:
+            # the envelope goes out once its linger is up
+            self.wake()
+            return []
+
+        return [(destination, items, {'batch': True})]
+
+    def get_due_envelopes(self, now=None, force=False):
+        if self.coalescer is None:
+            return []
+
+        with self.lock:
+            due = self.coalescer.get_due(now, force)
+
+        return [(destination, items, {'batch': True})
+                for destination, items in due]
+
+    def send_due_envelopes(self, now=None):
+        for envelope in self.get_due_envelopes(now):
+            self.send(*envelope)
+
+    def flush_envelopes(self):
+        # sends whatever is waiting in envelopes, e.g. before stopping
+        for envelope in self.get_due_envelopes(force=True):
+            self.send(*envelope)
+
+    def get_next_deadline(self):
+        if self.coalescer is None:
+            return None
+
+        return self.coalescer.get_next_deadline()
+
+    def run_due(self):
+        self.send_due_envelopes()
+
+    def get_codec(self, destination):
+        if self.codec.content_type == 'json':
+            return self.codec
+
+        return self.peer_codecs.get(destination, self.json_codec)
+
+    def get_accept(self):
+        # what this channel reads besides single frame JSON, sent in the
+        # accept header until the destination shows it read it
+        accept = ['multipart', 'zlib', 'batch']
+
+        if self.codec.content_type not in accept + ['json']:
+            accept.append(self.codec.content_type)
+
+        return accept
+
+    def accepts(self, destination, name):
+        return name in self.peer_accepts.get(destination, ())
+
+    def shows_accept(self, message, codec, multipart):
+        # whether message could only be sent by a peer that read our accept
+        headers = message['headers']
+
+        return (multipart or headers.get('encoding') == 'zlib'
+                or headers.get('batch')
+                or (codec is self.codec and codec.content_type != 'json'))
+
+    def track_peer(self, message, codec, multipart):
+        headers = message['headers']
+        source = headers.get('source')
+
+        if 'accept' in headers:
+            self.peer_accepts[source] = set(headers['accept'])
+
+        # a peer that restarted has forgotten our accept and lists its own
+        # again without using ours
+        if self.shows_accept(message, codec, multipart):
+            self.informed_peers.add(source)
+        elif 'accept' in headers:
+            self.informed_peers.discard(source)
+
+    def track_codec(self, message, codec):
+        # peers sending our codec or listing it in accept can be sent it
+        source = message['headers'].get('source')
+
+        if (codec.content_type == self.codec.content_type
+                or self.accepts(source, self.codec.content_type)):
+            self.peer_codecs[source] = self.codec
+
+    def pre_callback(self, frames):
+        if len(frames) > 1:
+            # routing, dedupe and acks only need the header frame
+            header = frames[1].bytes
+            codec = get_codec(header)
+            message = LazyMessage(codec.decode(header), frames[2], codec)
+        else:
+            body = self.get_body(frames[0].bytes)
+            codec = get_codec(body)
+            message = codec.decode(body)
+
+        self.track_peer(message, codec, len(frames) > 1)
+
+        if self.codec.content_type != 'json':
+            self.track_codec(message, codec)
+
+        return message
+
+    def pre_callback_many(self, messages):
+        return unpack(super(JsonChannel, self).pre_callback_many(messages))
+
+    def get_dispatch_key(self, message):
+        # messages from one source are handled in order
+        return message['headers'].get('source')
 
 
 class ReliableChannel(JsonChannel):
@@ -87,8 +581,35 @@ class ReliableChannel(JsonChannel):
         self.acknowledge_expiry = int(kwargs.get('acknowledge_expiry', 0))
         self.message_cache = kwargs.get('message_cache', OrderedMemoryMessageCache())
         self.dead_message_backend = kwargs.get('dead_message_backend', MemoryDeadMessageBackend())
+        self.retry_scheduler = kwargs.get('retry_scheduler', RetryScheduler())
+        self.page_size = int(kwargs.get('page_size', 500))
+        self.ack_batch_size = int(kwargs.get('ack_batch_size', 100))
+        self.ack_delay = float(kwargs.get('ack_delay', 0))
+        self.sequenced = bool(kwargs.get('sequenced', False))
+        self.nack_interval = float(kwargs.get('nack_interval', 0.5))
+        # a gap is given up on after this many NACKs, 0 never gives up
+        self.max_nacks = int(kwargs.get('max_nacks', 10))
+        # per destination in-flight limits in messages and bytes, 0 disables
+        # either, flow_control is one of 'queue', 'block' or 'error'
+        self.window_size = int(kwargs.get('window_size', 0))
+        self.window_bytes = int(kwargs.get('window_bytes', 0))
+        self.flow_control = kwargs.get('flow_control', 'queue')
+        # how long an executor's worker waits for room before its message
+        # is queued anyway, the receiving thread that opens windows may be
+        # waiting on that worker's queue
+        self.block_timeout = float(kwargs.get('block_timeout', 1))
+        # dead messages are replayed at most replay_rate a second
+        self.replay_rate = float(kwargs.get('replay_rate', 100))
+        # payload frames of this many unconfirmed messages are kept for
+        # their retransmits
+        self.payload_cache_size = int(kwargs.get('payload_cache_size', 1000))
 
-        remove_keys = ['send_expiry', 'acknowledge_expiry', 'message_cache', 'dead_message_backend']
+        remove_keys = ['send_expiry', 'acknowledge_expiry', 'message_cache',
+                       'dead_message_backend', 'retry_scheduler', 'page_size',
+                       'ack_batch_size', 'ack_delay', 'sequenced',
+                       'nack_interval', 'max_nacks', 'window_size',
+                       'window_bytes', 'flow_control', 'block_timeout',
+                       'replay_rate', 'payload_cache_size']
 
         for key in remove_keys:
             try:
@@ -96,47 +617,709 @@ class ReliableChannel(JsonChannel):
             except KeyError:
                 pass
 
+        if self.replay_rate <= 0:
+            raise ValueError("replay_rate must be positive")
+
         super(ReliableChannel, self).__init__(*args, **kwargs)
 
         self.current_message_id = self.generate_new_message_id()
+        self.loaded_unconfirmed = False
+        self.next_acknowledge = None
+
+        # sequenced session state, sequences are per destination and the
+        # outstanding ones are kept in send order
+        self.session = uuid.uuid4().hex
+        self.sequences = {}
+        self.outstanding = {}
+        self.outstanding_ids = {}
+        self.sequence_trackers = {}
+
+        self.windows = {}
+        self.window_ids = {}
+        self.window_callbacks = []
+        self.window_opened = threading.Condition(self.lock)
+
+        # group messages waiting for acks, message_id -> [members, bit per
+        # member, bitmask of members yet to ack], members are shared by
+        # messages sent to the same group
+        self.multicasts = {}
+        self.group_members = {}
+        # group messages some members acked since the last pass
+        self.acked_multicasts = set()
+
+        # message_id -> {(content type, compressed): payload frame}, least
+        # recently sent first
+        self.payloads = OrderedDict()
+
+        # details of the dead messages waiting to be replayed, they stay in
+        # the dead backend until they are stored to be sent again
+        self.replay_queue = deque()
+        self.replay_contexts = set()
+        self.replay_allowance = 0
+        self.last_replay = None
 
     def get_current_id(self):
         return self.identity + ":::" + str(self.current_message_id)
 
+    def get_accept(self):
+        return super(ReliableChannel, self).get_accept() + ['ack-batch']
+
+    def shows_accept(self, message, codec, multipart):
+        headers = message['headers']
+
+        return (super(ReliableChannel, self).shows_accept(message, codec, multipart)
+                or (headers.get('type') == 'ACK' and 'message_ids' in headers))
+
     def generate_new_message_id(self):
         return (str(time.time()) + str(uuid.uuid4()))
 
+    def get_next_deadline(self):
+        if not self.loaded_unconfirmed:
+            return 0
+
+        deadlines = [self.retry_scheduler.get_next_deadline(),
+                     self.next_acknowledge,
+                     super(ReliableChannel, self).get_next_deadline()]
+
+        if any(tracker.has_gaps() for tracker in self.sequence_trackers.values()):
+            deadlines.append(time.time() + self.nack_interval)
+        if self.replay_queue:
+            deadlines.append(time.time() + 1 / self.replay_rate)
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+
+        if not deadlines:
+            return None
+
+        return min(deadlines)
+
+    def run_due(self):
+        # runs after receiving too so that acks and replies generated by
+        # callbacks go out immediately
+        with self.lock:
+            self.synchronize()
+
+    def load_unconfirmed_messages(self):
+        # messages left over from a previous run are not in the scheduler,
+        # the backlog is streamed a page at a time
+        self.retry_scheduler.load()
+        message_ids = []
+
+        for message in self.message_cache.iter_unconfirmed_messages(self.page_size):
+            # messages sent since startup are either scheduled or waiting
+            # for room in their window already
+            if message['headers']['message_id'] in self.window_ids:
+                continue
+
+            message_ids.append(message['headers']['message_id'])
+            self.restore_members(message)
+
+            if len(message_ids) >= self.page_size:
+                self.retry_scheduler.schedule_new(message_ids)
+                message_ids = []
+
+        self.retry_scheduler.schedule_new(message_ids)
+
+        self.loaded_unconfirmed = True
+
+    def restore_members(self, message):
+        # members that acked before a restart are stored with the message
+        message_id = message['headers']['message_id']
+
+        if 'members' in message and message_id not in self.multicasts:
+            self.track_members(message_id, message['destination'],
+                               message['members'])
+            multicast = self.multicasts[message_id]
+
+            for member in message.get('acked_members', ()):
+                multicast[2] &= ~multicast[1].get(member, 0)
+
     def synchronize(self):
-        # resend unconfirmed messages
-        for message in self.message_cache.get_unconfirmed_messages():
-            if self.send_expiry and time.time() - message['timestamp'] > self.send_expiry:
-                self.dead_message_backend.store(message['headers']['message_id'],
-                                                message, "Retry time expired")
+        if not self.loaded_unconfirmed:
+            self.load_unconfirmed_messages()
+
+        now = time.time()
+
+        self.send_due_envelopes(now)
+        self.replay_due_messages(now)
+        self.resend_due_messages(now)
+        self.store_acked_members()
+        self.acknowledge_received_messages(now)
+        self.request_missing_messages(now)
+
+        # scheduler changes and dead messages of the whole pass are written
+        # at once
+        self.retry_scheduler.flush()
+        self.dead_message_backend.flush()
+
+    def resend_due_messages(self, now):
+        # a backlog bigger than a page is left due for the next pass
+        due = self.retry_scheduler.get_due(now, self.page_size)
+        messages = self.message_cache.get_sent_messages([message_id for message_id, _ in due])
+
+        for message_id in self.resend_messages(due, messages, now):
+            self.message_cache.discard(message_id)
+
+    def resend_messages(self, due, messages, now):
+        # resends due unconfirmed messages in the order they fell due and
+        # returns the ids of the ones that went dead
+        pending = dict(due)
+        retries = []
+        dead = []
+
+        for message in messages:
+            message_id = message['headers']['message_id']
+            attempts = pending.pop(message_id)
+
+            if message['status'] != 'SYN':
+                pending[message_id] = attempts
+                continue
+
+            if self.send_expiry and now - message['timestamp'] > self.send_expiry:
+                self.dead_message_backend.store(message_id, message,
+                                                "Retry time expired")
+                dead.append(message_id)
                 continue
-            print "Sending: {}".format(message)
-            super(ReliableChannel, self).send(message['destination'],
-                                              message['message'],
-                                              message['headers'])
-
-        # confirm received messages
-        for message in self.message_cache.get_received_syn_messages():
-            if self.acknowledge_expiry and time.time() - message['timestamp'] > self.acknowledge_expiry:
-                self.dead_message_backend.store(message['message']['headers']['message_id'],
-                                                message, "Acknoweledge time expired")
+
+            if self.retry_scheduler.is_exhausted(attempts):
+                self.dead_message_backend.store(message_id, message,
+                                                "Retry attempts exceeded")
+                dead.append(message_id)
+                continue
+
+            logger.debug("Sending: {}".format(message))
+            for destination in self.get_resend_destinations(message):
+                self.transmit(destination, message['message'],
+                              message['headers'])
+
+            if attempts and message_id in self.window_ids:
+                self.windows[self.window_ids[message_id]].retransmit(message_id)
+
+            retries.append((message_id, attempts + 1))
+
+        self.retry_scheduler.retry_many_later(retries, now)
+
+        for message_id in dead:
+            self.forget_sequence(message_id)
+            self.multicasts.pop(message_id, None)
+            self.payloads.pop(message_id, None)
+
+        self.release_windows(dead, now)
+
+        # whatever is left was confirmed or is gone from the cache
+        self.retry_scheduler.cancel_many(dead + list(pending))
+
+        return dead
+
+    def get_replay_filter(self, select=None):
+        # only sent messages are replayed, received ones went dead unacked
+        def is_replayable(details):
+            return (details['data'].get('class') == 'SEND'
+                    and details['context'] not in self.replay_contexts
+                    and (select is None or select(details)))
+
+        return is_replayable
+
+    def store_acked_members(self):
+        # group messages are stored again with the members that acked them
+        # so that a restart only asks the others
+        message_ids, self.acked_multicasts = list(self.acked_multicasts), set()
+
+        if not message_ids:
+            return
+
+        for message in self.message_cache.get_sent_messages(message_ids):
+            message_id = message['headers']['message_id']
+
+            if message_id in self.multicasts:
+                message['acked_members'] = self.get_acked_members(message_id)
+                self.message_cache.store_message_to_send(message_id, message)
+
+    def replay_dead_messages(self, select=None, limit=None):
+        # queues the dead sent messages matching select(details) to be sent
+        # again, returns how many were queued
+        with self.lock:
+            selected = self.dead_message_backend.select(self.get_replay_filter(select),
+                                                        limit, self.page_size)
+            self.queue_replays(selected)
+
+        self.wake()
+
+        return len(selected)
+
+    def queue_replays(self, selected):
+        self.replay_queue.extend(selected)
+        self.replay_contexts.update(details['context'] for details in selected)
+
+    def forget_replays(self, replays):
+        # returns the contexts to remove from the dead backend
+        contexts = [details['context'] for details in replays]
+        self.replay_contexts.difference_update(contexts)
+
+        return contexts
+
+    def get_due_replays(self, now):
+        # a token bucket holding up to a second's worth of replays, and at
+        # least one, so that a big backlog doesn't flood the router and the
+        # peers at once
+        if not self.replay_queue:
+            self.last_replay = None
+            return []
+
+        if self.last_replay is None:
+            self.replay_allowance = 1
+        else:
+            self.replay_allowance = min(
+                max(1, self.replay_rate),
+                self.replay_allowance + (now - self.last_replay) * self.replay_rate)
+
+        self.last_replay = now
+
+        count = min(int(self.replay_allowance), len(self.replay_queue),
+                    self.page_size)
+        self.replay_allowance -= count
+
+        return [self.replay_queue.popleft() for _ in range(count)]
+
+    def prepare_replay(self, message, now):
+        # replays keep their message_id so peers that got the original drop
+        # the copy, but expire and are sequenced anew
+        message = dict(message)
+        message['status'] = 'SYN'
+        message['timestamp'] = now
+
+        headers = dict(message['headers'])
+        for key in ('session', 'sequence', 'sequence_base'):
+            headers.pop(key, None)
+
+        if self.sequenced and 'group' not in headers:
+            headers.update(self.get_sequence_headers(message['destination'],
+                                                     headers['message_id']))
+
+        message['headers'] = headers
+
+        return message
+
+    def replay_due_messages(self, now):
+        replays = self.get_due_replays(now)
+
+        for details in replays:
+            message = self.prepare_replay(details['data'], now)
+            self.message_cache.store_message_to_send(message['headers']['message_id'],
+                                                     message)
+            self.admit_replay(message)
+
+        self.dead_message_backend.remove_many(self.forget_replays(replays))
+
+    def admit_replay(self, message):
+        self.restore_members(message)
+
+        window, size = self.get_window_and_size(message['destination'],
+                                                message['message'])
+        self.admit_message(message['headers']['message_id'],
+                           message['destination'], window, size)
+
+    def acknowledge_received_messages(self, now):
+        self.next_acknowledge = None
+        expired = []
+        pending = {}
+
+        for message in self.message_cache.iter_received_syn_messages(self.page_size):
+            full = self.queue_acknowledgement(message, now, expired, pending)
+
+            if full:
+                self.flush_acknowledgements(*full)
+
+        self.message_cache.mark_many_as_received(expired)
+
+        for destination, batch in self.get_due_acknowledgements(pending, now):
+            self.flush_acknowledgements(destination, batch)
+
+    def queue_acknowledgement(self, message, now, expired, pending):
+        # acks are grouped per peer and sent once a peer has ack_batch_size
+        # of them or the oldest has waited ack_delay seconds, returns a
+        # (destination, batch) that is full
+        message_id = message['message']['headers']['message_id']
+
+        if self.acknowledge_expiry and now - message['timestamp'] > self.acknowledge_expiry:
+            self.dead_message_backend.store(message_id, message,
+                                            "Acknoweledge time expired")
+            message['status'] = 'ACK'
+            expired.append((message_id, message))
+            return None
+
+        batch = pending.setdefault(message['destination'], [])
+        batch.append((message_id, message))
+
+        if len(batch) >= self.ack_batch_size:
+            return message['destination'], pending.pop(message['destination'])
+
+        return None
+
+    def get_due_acknowledgements(self, pending, now):
+        due = []
+
+        for destination, batch in pending.items():
+            oldest = min(message['timestamp'] for _, message in batch)
+
+            if now - oldest >= self.ack_delay:
+                due.append((destination, batch))
                 continue
-            message['message']['headers'].update({'type': 'ACK'})
-            super(ReliableChannel, self).send(message['destination'],
-                                              message['message']['data'],
-                                              message['message']['headers'])
-            # confirm as acked
+
+            deadline = oldest + self.ack_delay
+
+            if self.next_acknowledge is None or deadline < self.next_acknowledge:
+                self.next_acknowledge = deadline
+
+        return due
+
+    def flush_acknowledgements(self, destination, batch):
+        self.prepare_acknowledgements(destination, batch)
+        self.message_cache.mark_many_as_received(batch)
+
+    def prepare_acknowledgements(self, destination, batch):
+        self.send_acknowledgement(destination,
+                                  [message_id for message_id, _ in batch])
+
+        for _, message in batch:
             message['status'] = 'ACK'
-            self.message_cache.mark_as_received(message['message']['headers']['message_id'], message)
 
-    def send(self, destination, message_data, extra_headers=None):
+    def request_missing_messages(self, now):
+        for source, tracker in self.sequence_trackers.items():
+            if not tracker.has_gaps():
+                continue
+
+            missing = tracker.get_missing(now, self.nack_interval)
+
+            if missing:
+                self.send_negative_acknowledgement(source, tracker.session,
+                                                   missing)
+
+    def track_members(self, message_id, group, members):
+        members = tuple(members)
+        current = self.group_members.get(group)
+
+        if current is None or current[0] != members:
+            bits = dict((member, 1 << bit) for bit, member in enumerate(members))
+            current = self.group_members[group] = (members, bits)
+
+        self.multicasts[message_id] = [current[0], current[1],
+                                       (1 << len(members)) - 1]
+
+    def get_pending_members(self, message_id):
+        members, bits, pending = self.multicasts[message_id]
+        return [member for member in members if pending & bits[member]]
+
+    def get_acked_members(self, message_id):
+        members, bits, pending = self.multicasts[message_id]
+        return [member for member in members if not pending & bits[member]]
+
+    def get_resend_destinations(self, message):
+        # members still missing a group message get their own copy unless
+        # most of the group is missing it
+        message_id = message['headers']['message_id']
+
+        if message_id not in self.multicasts:
+            return [message['destination']]
+
+        pending = self.get_pending_members(message_id)
+
+        if len(pending) * 2 < len(self.multicasts[message_id][0]):
+            return pending
+
+        return [message['destination']]
+
+    def get_confirmed_ids(self, message_ids, source):
+        # a group message is confirmed once every member acked it
+        confirmed = []
+
+        for message_id in message_ids:
+            multicast = self.multicasts.get(message_id)
+
+            if multicast is None:
+                confirmed.append(message_id)
+                continue
+
+            pending = multicast[2] & ~multicast[1].get(source, 0)
+
+            if pending == multicast[2]:
+                continue
+
+            multicast[2] = pending
+
+            if pending:
+                self.acked_multicasts.add(message_id)
+            else:
+                del self.multicasts[message_id]
+                confirmed.append(message_id)
+
+        return confirmed
+
+    def send_negative_acknowledgement(self, destination, session, sequences):
         headers = {
-            'message_id': self.get_current_id()
+            'type': 'NACK',
+            'session': session,
+            'sequences': sequences
+        }
+
+        self.transmit(destination, None, headers)
+
+    def get_sequence_headers(self, destination, message_id):
+        sequence = self.sequences.get(destination, 0) + 1
+        self.sequences[destination] = sequence
+
+        outstanding = self.outstanding.setdefault(destination, OrderedDict())
+        outstanding[sequence] = message_id
+        self.outstanding_ids[message_id] = (destination, sequence)
+
+        # everything below the oldest outstanding sequence is confirmed
+        return {
+            'session': self.session,
+            'sequence': sequence,
+            'sequence_base': next(iter(outstanding))
         }
 
+    def forget_sequence(self, message_id):
+        if message_id not in self.outstanding_ids:
+            return
+
+        destination, sequence = self.outstanding_ids.pop(message_id)
+        self.outstanding[destination].pop(sequence, None)
+
+    def track_sequence(self, message):
+        # only peers sending their session and sequences are tracked, and
+        # so ever sent a NACK, older peers don't know them
+        headers = message['headers']
+
+        if 'sequence' not in headers or 'session' not in headers:
+            return
+
+        tracker = self.sequence_trackers.get(headers['source'])
+
+        if tracker is None or tracker.session != headers['session']:
+            tracker = SequenceTracker(headers['session'],
+                                      max_requests=self.max_nacks)
+            self.sequence_trackers[headers['source']] = tracker
+
+        tracker.receive(headers['sequence'], headers.get('sequence_base'))
+
+    def register_window_callback(self, callback):
+        # called with the destination whenever queued messages are let
+        # through its window
+        self.window_callbacks.append(callback)
+
+    def get_window(self, destination):
+        if not self.window_size and not self.window_bytes:
+            return None
+
+        if destination not in self.windows:
+            self.windows[destination] = FlowWindow(self.window_size,
+                                                   self.window_bytes)
+
+        return self.windows[destination]
+
+    def get_window_and_size(self, destination, message_data):
+        window = self.get_window(destination)
+
+        if window is None or not self.window_bytes:
+            return window, 0
+
+        return window, len(self.codec.encode(message_data))
+
+    def wait_for_window(self, window, size):
+        if self.executor is not None and self.executor.is_worker():
+            # the receiving thread opens the window as acks come in
+            end = time.time() + self.block_timeout
+
+            with self.window_opened:
+                while not window.is_open(size):
+                    remaining = end - time.time()
+
+                    if remaining <= 0:
+                        return
+
+                    self.window_opened.wait(remaining)
+
+            return
+
+        # keeps the channel running until there is room, not to be used from
+        # inside inline callbacks
+        while not window.is_open(size):
+            self.run_once()
+
+    def release_windows(self, message_ids, now):
+        released = {}
+
+        for message_id in message_ids:
+            destination = self.window_ids.pop(message_id, None)
+
+            if destination is None:
+                continue
+
+            window = self.windows[destination]
+            window.release(message_id, now)
+            released[destination] = window
+
+        for destination, window in released.items():
+            drained = window.drain(now)
+
+            if not drained:
+                continue
+
+            self.retry_scheduler.schedule_new(drained, now)
+
+            for callback in self.window_callbacks:
+                callback(destination)
+
+        if released:
+            with self.window_opened:
+                self.window_opened.notify_all()
+
+    def transmit(self, destination, message_data, headers):
+        # sends acks, control messages and what the cache holds as they are
+        return super(ReliableChannel, self).send(destination, message_data,
+                                                 headers)
+
+    def encode_payload(self, destination, codec, message_data, headers):
+        # retransmits reuse the frame encoded, and compressed, the first time
+        message_id = headers.get('message_id')
+
+        if message_id is None or headers.get('type') == 'ACK' or not self.payload_cache_size:
+            return super(ReliableChannel, self).encode_payload(destination, codec,
+                                                               message_data, headers)
+
+        variants = self.payloads.pop(message_id, None) or {}
+        variant = (codec.content_type, self.should_compress(destination))
+
+        if variant not in variants:
+            variants[variant] = super(ReliableChannel, self).encode_payload(
+                destination, codec, message_data, headers)
+
+        self.payloads[message_id] = variants
+
+        while len(self.payloads) > self.payload_cache_size:
+            self.payloads.popitem(last=False)
+
+        return variants[variant]
+
+    def send_control(self, destination, message_type):
+        # unreliable message without a message_id, e.g. JOIN, LEAVE or
+        # HEARTBEAT for a PresenceRegistry on the other side
+        headers = {
+            'type': message_type
+        }
+
+        self.transmit(destination, None, headers)
+
+    def get_dropped_ids(self, destination, message):
+        # ids confirmed by destination going away, None if the unconfirmed
+        # message wasn't waiting on destination
+        message_id = message['headers']['message_id']
+
+        if message['destination'] == destination:
+            return [message_id]
+
+        if (message_id in self.multicasts
+                and destination in self.get_pending_members(message_id)):
+            return self.get_confirmed_ids([message_id], destination)
+
+        return None
+
+    def is_catch_up(self, message):
+        # replies and other typed messages are confirmed along with the
+        # rest but are no use to catch a peer up with
+        return 'type' not in message['headers']
+
+    def drop_destination(self, destination):
+        # stops retransmitting to a peer that went away and returns what it
+        # never confirmed so that it can be caught up some other way
+        with self.lock:
+            dropped = []
+            confirmed = []
+
+            for message in self.message_cache.iter_unconfirmed_messages(self.page_size):
+                message_ids = self.get_dropped_ids(destination, message)
+
+                if message_ids is not None:
+                    if self.is_catch_up(message):
+                        dropped.append(message)
+
+                    confirmed.extend(message_ids)
+
+            self.message_cache.confirm_many(confirmed)
+            self.handle_acknowledged(confirmed)
+
+        return dropped
+
+    def send_acknowledgement(self, destination, message_ids):
+        # a compact ack only carries the ids it confirms, peers that didn't
+        # list ack-batch in accept get an ack per message
+        if self.accepts(destination, 'ack-batch'):
+            headers = {
+                'type': 'ACK',
+                'message_ids': message_ids
+            }
+
+            self.transmit(destination, None, headers)
+            return
+
+        for message_id in message_ids:
+            headers = {
+                'type': 'ACK',
+                'message_id': message_id
+            }
+
+            self.transmit(destination, None, headers)
+
+    def send_to_group(self, group, members, message_data, extra_headers=None):
+        # one publish on the group topic instead of one message per member
+        if members:
+            self.send(group, message_data, extra_headers, members)
+
+    def send(self, destination, message_data, extra_headers=None, members=None):
+        # envelopes are sent, and acked, like any other message
+        if members is None and self.is_coalesced(destination, extra_headers):
+            for envelope in self.coalesce(destination, message_data, extra_headers):
+                self.send(*envelope)
+
+            return
+
+        window, size = self.get_window_and_size(destination, message_data)
+
+        if window is not None and not window.is_open(size):
+            if self.flow_control == 'error':
+                raise WindowFull(destination)
+
+            if self.flow_control == 'block':
+                self.wait_for_window(window, size)
+
+        with self.lock:
+            message_id, message_to_store = self.build_message(destination,
+                                                              message_data,
+                                                              extra_headers,
+                                                              members)
+
+            self.message_cache.store_message_to_send(message_id, message_to_store)
+
+            self.admit_message(message_id, destination, window, size)
+
+        self.wake()
+
+    def build_message(self, destination, message_data, extra_headers=None,
+                      members=None):
+        message_id = self.get_current_id()
+        self.current_message_id = self.generate_new_message_id()
+
+        headers = {
+            'message_id': message_id
+        }
+
+        # group messages aren't sequenced, members track sequences per source
+        if members is not None:
+            headers['group'] = destination
+            self.track_members(message_id, destination, members)
+        elif self.sequenced:
+            headers.update(self.get_sequence_headers(destination, message_id))
+
         if extra_headers:
             headers.update(extra_headers)
 
@@ -149,45 +1332,132 @@ class ReliableChannel(JsonChannel):
             'timestamp': time.time()
         }
 
-        self.message_cache.store_message_to_send(self.get_current_id(),
-                                                 message_to_store)
+        if members is not None:
+            message_to_store['members'] = list(members)
 
-        self.current_message_id = self.generate_new_message_id()
+        return message_id, message_to_store
+
+    def admit_message(self, message_id, destination, window, size):
+        if window is None:
+            # first transmission happens on the next synchronize
+            self.retry_scheduler.schedule(message_id)
+            return
+
+        self.window_ids[message_id] = destination
+
+        if window.is_open(size):
+            window.acquire(message_id, size, time.time())
+            self.retry_scheduler.schedule(message_id)
+        else:
+            window.enqueue(message_id, size)
+
+    def get_requested_ids(self, message):
+        headers = message['headers']
+
+        if headers.get('session') != self.session:
+            return []
+
+        outstanding = self.outstanding.get(headers.get('source'), {})
+
+        return [outstanding[sequence] for sequence in headers.get('sequences', ())
+                if sequence in outstanding]
 
     def pre_callback(self, message):
-        message = super(ReliableChannel, self).pre_callback(message)
+        messages = self.pre_callback_many([message])
 
-        message_id = message['headers']['message_id']
+        if messages:
+            return messages[0]
 
-        if 'type' in message['headers'] and message['headers']['type'] == 'ACK':
-            if self.message_cache.is_unconfirmed(message_id):
-                self.message_cache.confirm(message_id)
+        return None
 
-            return None
+    def pre_callback_many(self, messages):
+        acknowledged, requested, received, control = self.sort_messages(messages)
+
+        if acknowledged:
+            self.message_cache.confirm_many(acknowledged)
+            self.handle_acknowledged(acknowledged)
+
+        if requested:
+            self.retry_scheduler.retry_now(requested)
+
+        if not received:
+            return unpack(control)
+
+        message_ids = [message['headers']['message_id'] for message in received]
+        already_received = self.message_cache.are_already_received(message_ids)
 
-        if self.message_cache.is_already_received(message_id):
+        to_mark, to_callback = self.get_received_marks(received, already_received)
+
+        self.message_cache.mark_many_as_received(to_mark)
+
+        return unpack(control + to_callback)
+
+    def sort_messages(self, messages):
+        # decodes a batch and splits it into acknowledged ids, ids requested
+        # again, messages received and unreliable control messages
+        acknowledged = []
+        requested = []
+        received = []
+        control = []
+
+        for message in messages:
+            message = super(ReliableChannel, self).pre_callback(message)
+            message_type = message['headers'].get('type')
+
+            if message_type == 'ACK':
+                # older peers ack one message at a time with a copy of it
+                message_ids = (message['headers'].get('message_ids')
+                               or [message['headers']['message_id']])
+                acknowledged.extend(self.get_confirmed_ids(message_ids,
+                                                           message['headers'].get('source')))
+                continue
+
+            if message_type == 'NACK':
+                requested.extend(self.get_requested_ids(message))
+                continue
+
+            # e.g. presence messages, passed to callbacks as they are
+            if 'message_id' not in message['headers']:
+                control.append(message)
+                continue
+
+            self.track_sequence(message)
+            received.append(message)
+
+        return acknowledged, requested, received, control
+
+    def handle_acknowledged(self, message_ids):
+        self.retry_scheduler.cancel_many(message_ids)
+
+        for message_id in message_ids:
+            self.forget_sequence(message_id)
+            self.payloads.pop(message_id, None)
+
+        self.release_windows(message_ids, time.time())
+
+    def get_received_marks(self, received, already_received):
+        to_mark = []
+        to_callback = []
+        seen = set()
+
+        for message, duplicate in zip(received, already_received):
+            message_id = message['headers']['message_id']
+            # only the headers are kept, acks don't need the data
             message_received = {
                 'class': 'RECEIVE',
-                'message': message,
+                'message': {'headers': message['headers']},
                 'destination': message['headers']['source'],
                 'status': 'SYN',
                 'timestamp': time.time()
             }
 
-            # mark message for ack'ing
-            self.message_cache.mark_as_received(message_id, message_received)
-
+            # mark message for ack'ing, duplicates are acked again but
             # don't callback
-            return None
+            to_mark.append((message_id, message_received))
 
-        message_received = {
-            'class': 'RECEIVE',
-            'message': message,
-            'destination': message['headers']['source'],
-            'status': 'SYN',
-            'timestamp': time.time()
-        }
+            if not duplicate and message_id not in seen:
+                to_callback.append(message)
 
-        self.message_cache.mark_as_received(message_id, message_received)
+            seen.add(message_id)
 
-        return message
+        return to_mark, to_callback
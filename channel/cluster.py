@@ -0,0 +1,195 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import zlib
+
+import zmq
+
+from .channel import ReliableChannel
+from .codec import decode, decode_headers
+
+logger = logging.getLogger(__name__)
+
+
+def get_partition(key, partitions):
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+
+    return (zlib.crc32(key) & 0xffffffff) % partitions
+
+
+def get_worker_identity(identity, index):
+    # workers reply under their own identity so acks for what they send
+    # come straight back to them
+    return "{}.{}".format(identity, index)
+
+
+class Dispatcher(object):
+
+    def __init__(self, identity, receive_from, worker_endpoints, context=None):
+        # receives everything sent to identity and pushes every message to
+        # the worker owning its source, addressed to that worker
+        self.identity = identity
+        self.context = context or zmq.Context.instance()
+
+        # messages for identity only reach the shard owning it, being
+        # connected to the others is harmless
+        if not isinstance(receive_from, (list, tuple)):
+            receive_from = [receive_from]
+
+        self.receiver = self.context.socket(zmq.SUB)
+        for endpoint in receive_from:
+            self.receiver.connect(endpoint)
+        self.receiver.setsockopt(zmq.SUBSCRIBE, (identity + "::").encode("utf-8"))
+
+        self.workers = []
+        for endpoint in worker_endpoints:
+            worker = self.context.socket(zmq.PUSH)
+            worker.bind(endpoint)
+            self.workers.append(worker)
+
+        self.worker_identities = [get_worker_identity(identity, index)
+                                  for index in range(len(self.workers))]
+
+        self.running = False
+
+    def get_source(self, frames):
+        # only the headers are decoded
+        if len(frames) > 1:
+            return decode(frames[1].bytes)['source']
+
+        return decode_headers(frames[0].bytes[len(self.identity) + 2:])['source']
+
+    def route(self, frames):
+        try:
+            index = get_partition(self.get_source(frames), len(self.workers))
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Dropping unroutable message: {!r}".format(frames[0].bytes))
+            return
+
+        prefix = (self.worker_identities[index] + "::").encode("utf-8")
+
+        if len(frames) > 1:
+            frames = [prefix] + frames[1:]
+        else:
+            frames = [prefix + frames[0].bytes[len(self.identity) + 2:]]
+
+        # a full worker queue blocks here, pushing back on the router
+        self.workers[index].send_multipart(frames, copy=False)
+
+    def run_once(self, timeout=None, max_messages=100):
+        if timeout is not None:
+            timeout = max(0, int(timeout * 1000))
+
+        if not self.receiver.poll(timeout):
+            return
+
+        for _ in range(max_messages):
+            try:
+                self.route(self.receiver.recv_multipart(zmq.DONTWAIT, copy=False))
+            except zmq.Again:
+                return
+
+    def run_forever(self, timeout=0.1, max_messages=100):
+        self.running = True
+
+        while self.running:
+            self.run_once(timeout, max_messages)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.receiver.close()
+
+        for worker in self.workers:
+            worker.close()
+
+
+def run_worker(identity, publish_to, receive_from, endpoint, channel_factory,
+               tick=None, tick_interval=1):
+    channel = channel_factory(identity, publish_to, receive_from)
+    channel.add_receiver(endpoint)
+
+    try:
+        if tick is None:
+            channel.run_forever()
+            return
+
+        # tick(channel) runs every tick_interval seconds whether messages
+        # arrive or not, e.g. to expire presence
+        channel.running = True
+        next_tick = time.time() + tick_interval
+
+        while channel.running:
+            channel.run_once(max(0, next_tick - time.time()))
+
+            if time.time() >= next_tick:
+                tick(channel)
+                next_tick = time.time() + tick_interval
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool(object):
+
+    def __init__(self, identity, publish_to, receive_from, workers=None,
+                 channel_factory=None, socket_dir=None, tick=None,
+                 tick_interval=1):
+        # channel_factory(identity, publish_to, receive_from) builds each
+        # worker's channel in the worker process, caches should be named
+        # after the worker identity it is given, tick(channel) is run in
+        # the worker every tick_interval seconds
+        self.identity = identity
+        self.publish_to = publish_to
+        self.receive_from = receive_from
+        self.workers = workers or multiprocessing.cpu_count()
+        self.channel_factory = channel_factory or ReliableChannel
+        self.tick = tick
+        self.tick_interval = tick_interval
+
+        socket_dir = socket_dir or tempfile.gettempdir()
+        self.endpoints = ["ipc://{}".format(os.path.join(socket_dir, "{}-{}".format(identity, index)))
+                          for index in range(self.workers)]
+
+        self.processes = []
+        self.dispatcher = None
+
+    def start(self):
+        # workers are started before the dispatcher creates any sockets,
+        # zmq contexts don't survive a fork
+        for index, endpoint in enumerate(self.endpoints):
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(get_worker_identity(self.identity, index),
+                      self.publish_to, self.receive_from, endpoint,
+                      self.channel_factory, self.tick, self.tick_interval))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        self.dispatcher = Dispatcher(self.identity, self.receive_from,
+                                     self.endpoints)
+
+    def run_forever(self):
+        if self.dispatcher is None:
+            self.start()
+
+        try:
+            self.dispatcher.run_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+            self.dispatcher.close()
+            self.dispatcher = None
+
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+        self.processes = []
@@ -0,0 +1,90 @@
+import time
+
+from collections import OrderedDict
+
+
+class Coalescer(object):
+
+    def __init__(self, max_messages=50, max_bytes=0, linger=5):
+        # packs messages for the same destination into one envelope that is
+        # sent once it holds max_messages messages or max_bytes of data, or
+        # its first message has waited linger milliseconds
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.linger = linger / 1000.0
+
+        # destination -> [items, bytes, time of the first message], in the
+        # order envelopes were started
+        self.envelopes = OrderedDict()
+
+    def add(self, destination, message_data, extra_headers=None, size=0,
+            now=None):
+        # returns the envelope's items once it is full
+        envelope = self.envelopes.get(destination)
+
+        if envelope is None:
+            envelope = [[], 0, now or time.time()]
+            self.envelopes[destination] = envelope
+
+        item = {
+            'data': message_data
+        }
+
+        if extra_headers:
+            item['headers'] = extra_headers
+
+        envelope[0].append(item)
+        envelope[1] += size
+
+        if (len(envelope[0]) >= self.max_messages
+                or (self.max_bytes and envelope[1] >= self.max_bytes)):
+            return self.pop(destination)
+
+        return None
+
+    def pop(self, destination):
+        return self.envelopes.pop(destination)[0]
+
+    def get_next_deadline(self):
+        if not self.envelopes:
+            return None
+
+        return next(iter(self.envelopes.values()))[2] + self.linger
+
+    def get_due(self, now=None, force=False):
+        # (destination, items) of the envelopes that waited long enough,
+        # all of them with force
+        now = now or time.time()
+        due = []
+
+        for destination, envelope in list(self.envelopes.items()):
+            if not force and now - envelope[2] < self.linger:
+                break
+
+            due.append((destination, self.pop(destination)))
+
+        return due
+
+
+def unpack(messages):
+    # replaces envelopes with the messages packed in them, which share the
+    # envelope's headers and message_id
+    unpacked = []
+
+    for message in messages:
+        if not message['headers'].get('batch'):
+            unpacked.append(message)
+            continue
+
+        for index, item in enumerate(message['data']):
+            headers = dict(message['headers'])
+            del headers['batch']
+            headers['batch_index'] = index
+            headers.update(item.get('headers') or {})
+
+            unpacked.append({
+                'headers': headers,
+                'data': item['data']
+            })
+
+    return unpacked
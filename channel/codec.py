@@ -0,0 +1,191 @@
+import json
+import sys
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(object):
+    # encoded bodies start with the codec's marker so that receivers can
+    # tell codecs apart, JSON objects start with "{" as they always have
+    content_type = None
+    marker = None
+
+    def encode(self, data):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    content_type = 'json'
+    marker = b'{'
+
+    def encode(self, data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    content_type = 'msgpack'
+    marker = b'\x01'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("MsgpackCodec needs the msgpack package")
+
+        # python 2 strings are packed as text so that both versions read
+        # them back the way they read JSON
+        self.use_bin_type = sys.version_info[0] >= 3
+
+    def encode(self, data):
+        return self.marker + msgpack.packb(data, use_bin_type=self.use_bin_type)
+
+    def decode(self, data):
+        return msgpack.unpackb(data[1:], raw=False, strict_map_key=False)
+
+
+class CompressingCodec(Codec):
+    # compresses what codec encodes once it is bigger than threshold bytes,
+    # zlib streams start with "x" which tells them apart from other codecs
+    content_type = 'zlib'
+    marker = b'x'
+
+    def __init__(self, codec=None, threshold=1024, level=6):
+        self.codec = codec or JsonCodec()
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, data):
+        return compress(self.codec.encode(data), self.threshold, self.level)
+
+    def decode(self, data):
+        return decode(zlib.decompress(data))
+
+
+class LazyMessage(dict):
+
+    def __init__(self, headers, payload, codec):
+        # a received message whose data is decoded from its payload frame
+        # the first time it is read
+        super(LazyMessage, self).__init__(headers=headers)
+        self.payload = payload
+        self.codec = codec
+
+    def load(self):
+        if self.payload is not None:
+            payload, self.payload = self.payload, None
+            payload = getattr(payload, 'bytes', payload)
+
+            if self['headers'].get('encoding') == 'zlib':
+                payload = zlib.decompress(payload)
+
+            self['data'] = self.codec.decode(payload)
+
+        return self
+
+    def __missing__(self, key):
+        if key == 'data' and self.payload is not None:
+            return self.load()['data']
+
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key == 'data':
+            self.load()
+
+        return super(LazyMessage, self).get(key, default)
+
+    def __contains__(self, key):
+        return key == 'data' or super(LazyMessage, self).__contains__(key)
+
+    def __iter__(self):
+        return super(LazyMessage, self.load()).__iter__()
+
+    def __len__(self):
+        return super(LazyMessage, self.load()).__len__()
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        return super(LazyMessage, self.load()).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def keys(self):
+        return super(LazyMessage, self.load()).keys()
+
+    def values(self):
+        return super(LazyMessage, self.load()).values()
+
+    def items(self):
+        return super(LazyMessage, self.load()).items()
+
+    def copy(self):
+        return dict(self.load())
+
+    def __repr__(self):
+        return super(LazyMessage, self.load()).__repr__()
+
+
+codecs = {}
+
+
+def register_codec(codec):
+    codecs[codec.marker] = codec
+    codecs[codec.content_type] = codec
+
+
+def get_codec(data):
+    # the codec that encoded data
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+
+    try:
+        return codecs[data[:1]]
+    except KeyError:
+        raise ValueError("Unknown content type: {!r}".format(data[:1]))
+
+
+def decode(data):
+    return get_codec(data).decode(data)
+
+
+def decode_headers(data):
+    # the headers of a single frame JSON message are read without decoding
+    # its data, they are encoded first
+    prefix = b'{"headers":'
+
+    if data.startswith(prefix):
+        return json.JSONDecoder().raw_decode(data.decode('utf-8'), len(prefix))[0]
+
+    return decode(data)['headers']
+
+
+def compress(data, threshold, level=6):
+    # a threshold of 0 never compresses
+    if threshold and len(data) > threshold:
+        return zlib.compress(data, level)
+
+    return data
+
+
+register_codec(JsonCodec())
+register_codec(CompressingCodec())
+
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
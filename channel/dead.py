@@ -1,36 +1,149 @@
-import json
+import time
+
+from collections import OrderedDict
+
+from .codec import JsonCodec, decode
 
 
 class DeadMessageBackend(object):
 
-    def store(context, comment):
-        return NotImplementedError()
+    def store(self, context, data, comment):
+        raise NotImplementedError()
 
+    def iter_messages(self, page_size=None):
+        # yields the details of every dead message, oldest first where the
+        # backend keeps an order
+        raise NotImplementedError()
 
-class MemoryDeadMessageBackend(object):
+    def remove_many(self, contexts):
+        raise NotImplementedError()
 
-    def __init__(self):
-        self.message_store = {}
+    def flush(self):
+        # writes out buffered messages, called once per synchronize
+        pass
 
-    def store(self, context, data, comment):
-        details = {
+    def get_details(self, context, data, comment):
+        return {
             "comment": comment,
             "context": context,
-            "data": data
+            "data": data,
+            "timestamp": time.time()
         }
-        self.message_store[context] = details
 
+    def select(self, select=None, limit=None, page_size=None):
+        # dead messages matching select(details), e.g. to be replayed
+        selected = []
+
+        for details in self.iter_messages(page_size):
+            if select is None or select(details):
+                selected.append(details)
+
+                if limit and len(selected) >= limit:
+                    break
+
+        return selected
+
+
+class MemoryDeadMessageBackend(DeadMessageBackend):
+
+    def __init__(self, max_size=10000, ttl=0):
+        # the oldest messages go first once there are more than max_size or
+        # they are older than ttl seconds, 0 disables either limit
+        self.max_size = max_size
+        self.ttl = ttl
+        self.message_store = OrderedDict()
+
+    def store(self, context, data, comment):
+        self.message_store.pop(context, None)
+        self.message_store[context] = self.get_details(context, data, comment)
+        self.evict()
+
+    def evict(self, now=None):
+        if self.max_size:
+            while len(self.message_store) > self.max_size:
+                self.message_store.popitem(last=False)
+
+        if self.ttl:
+            now = now or time.time()
+
+            while self.message_store:
+                oldest = next(iter(self.message_store.values()))
+
+                if now - oldest["timestamp"] <= self.ttl:
+                    break
+
+                self.message_store.popitem(last=False)
+
+    def iter_messages(self, page_size=None):
+        self.evict()
+        return iter(list(self.message_store.values()))
+
+    def remove_many(self, contexts):
+        for context in contexts:
+            self.message_store.pop(context, None)
 
-class RedisDeadMessageBackend(object):
 
-    def __init__(self, redis_connection, store_name):
+class RedisDeadMessageBackend(DeadMessageBackend):
+
+    def __init__(self, redis_connection, store_name, max_size=0, ttl=0,
+                 batch_size=100, codec=None):
+        # messages are buffered and written a batch at a time, with their
+        # contexts in a sorted set by time so the oldest can be trimmed
         self.r = redis_connection
         self.store_name = store_name
+        self.index_name = store_name + "_index"
+        self.max_size = max_size
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.codec = codec or JsonCodec()
+        self.buffer = []
 
     def store(self, context, data, comment):
-        details = {
-            "comment": comment,
-            "context": context,
-            "data": data
-        }
-        self.r.hset(self.store_name, context, json.dumps(details))
+        self.buffer.append(self.get_details(context, data, comment))
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        pipe = self.r.pipeline(transaction=True)
+
+        for details in self.buffer:
+            pipe.hset(self.store_name, details["context"], self.codec.encode(details))
+            pipe.zadd(self.index_name, {details["context"]: details["timestamp"]})
+
+        pipe.execute()
+        self.buffer = []
+
+        self.evict()
+
+    def evict(self, now=None):
+        expired = []
+
+        if self.ttl:
+            now = now or time.time()
+            expired.extend(self.r.zrangebyscore(self.index_name, '-inf',
+                                                now - self.ttl))
+
+        if self.max_size:
+            expired.extend(self.r.zrange(self.index_name, 0,
+                                         -self.max_size - 1))
+
+        self.remove_many(expired)
+
+    def iter_messages(self, page_size=None):
+        self.flush()
+
+        for _, details in self.r.hscan_iter(self.store_name, count=page_size or self.batch_size):
+            yield decode(details)
+
+    def remove_many(self, contexts):
+        if not contexts:
+            return
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hdel(self.store_name, *contexts)
+        pipe.zrem(self.index_name, *contexts)
+        pipe.execute()
@@ -0,0 +1,144 @@
+import hashlib
+import math
+import struct
+import time
+
+from collections import OrderedDict
+
+
+class Deduplicator(object):
+
+    def is_duplicate(self, message_id):
+        raise NotImplementedError()
+
+    def add(self, message_id):
+        raise NotImplementedError()
+
+    def are_duplicates(self, message_ids):
+        return [self.is_duplicate(message_id) for message_id in message_ids]
+
+    def add_many(self, message_ids):
+        for message_id in message_ids:
+            self.add(message_id)
+
+
+class WindowedDeduplicator(Deduplicator):
+
+    def __init__(self, max_size=100000, window=None):
+        # ids are forgotten least recently added first once there are more
+        # than max_size of them, or once they are older than window seconds
+        self.max_size = max_size
+        self.window = window
+        self.message_ids = OrderedDict()
+
+    def is_duplicate(self, message_id):
+        # expired ids go on lookup too, an idle receiver adds nothing that
+        # would evict them
+        self.evict()
+        return message_id in self.message_ids
+
+    def add(self, message_id):
+        self.message_ids.pop(message_id, None)
+        self.message_ids[message_id] = time.time()
+        self.evict()
+
+    def evict(self, now=None):
+        if self.max_size:
+            while len(self.message_ids) > self.max_size:
+                self.message_ids.popitem(last=False)
+
+        if self.window:
+            if now is None:
+                now = time.time()
+
+            while self.message_ids:
+                oldest = next(iter(self.message_ids))
+
+                if now - self.message_ids[oldest] <= self.window:
+                    break
+
+                del self.message_ids[oldest]
+
+
+class BloomDeduplicator(Deduplicator):
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        # a pair of bloom filters, the current one is retired once it holds
+        # capacity ids so at least the last `capacity` ids are remembered
+        # in 2 * size bits, each filter gets half the error rate since a
+        # lookup checks both
+        self.capacity = capacity
+        error_rate = error_rate / 2.0
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / float(capacity) * math.log(2))))
+
+        self.current = bytearray((self.size + 7) // 8)
+        self.previous = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, message_id):
+        if not isinstance(message_id, bytes):
+            message_id = message_id.encode("utf-8")
+
+        digest = hashlib.md5(message_id).digest()
+        first, second = struct.unpack("<QQ", digest)
+
+        return [(first + i * second) % self.size
+                for i in range(self.hash_count)]
+
+    def contains(self, bits, positions):
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+    def is_duplicate(self, message_id):
+        positions = self.get_positions(message_id)
+        return (self.contains(self.current, positions)
+                or self.contains(self.previous, positions))
+
+    def add(self, message_id):
+        if self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(len(self.previous))
+            self.count = 0
+
+        for position in self.get_positions(message_id):
+            self.current[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+
+class RedisDeduplicator(Deduplicator):
+
+    def __init__(self, redis_connection, name, window=24 * 60 * 60):
+        # one expiring key per id, redis drops them after window seconds
+        self.r = redis_connection
+        self.name = name
+        self.window = window
+
+    def get_key(self, message_id):
+        return self.name + ":" + message_id
+
+    def is_duplicate(self, message_id):
+        return bool(self.r.exists(self.get_key(message_id)))
+
+    def add(self, message_id):
+        self.r.set(self.get_key(message_id), 1, ex=self.window)
+
+    def are_duplicates(self, message_ids):
+        pipe = self.r.pipeline(transaction=False)
+
+        for message_id in message_ids:
+            pipe.exists(self.get_key(message_id))
+
+        return [bool(exists) for exists in pipe.execute()]
+
+    def add_many(self, message_ids):
+        pipe = self.r.pipeline(transaction=False)
+
+        for message_id in message_ids:
+            pipe.set(self.get_key(message_id), 1, ex=self.window)
+
+        pipe.execute()
@@ -0,0 +1,69 @@
+import logging
+import threading
+import zlib
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedExecutor(object):
+
+    def __init__(self, workers=4, max_queue=1000):
+        # tasks with the same key always run on the same worker in the order
+        # they were submitted, submit blocks once a worker has max_queue
+        # tasks waiting so a slow consumer slows down the producer
+        self.queues = [Queue(max_queue) for _ in range(workers)]
+        self.threads = []
+
+        for queue in self.queues:
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def get_queue(self, key):
+        if key is None:
+            return self.queues[0]
+
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+
+        return self.queues[(zlib.crc32(key) & 0xffffffff) % len(self.queues)]
+
+    def submit(self, key, function, *args):
+        self.get_queue(key).put((function, args))
+
+    def is_worker(self):
+        return threading.current_thread() in self.threads
+
+    def work(self, queue):
+        while True:
+            task = queue.get()
+
+            try:
+                if task is None:
+                    return
+
+                function, args = task
+                function(*args)
+            except Exception:
+                logger.exception("Task failed")
+            finally:
+                queue.task_done()
+
+    def join(self):
+        # waits for everything submitted so far to run
+        for queue in self.queues:
+            queue.join()
+
+    def shutdown(self, wait=True):
+        for queue in self.queues:
+            queue.put(None)
+
+        if wait:
+            for thread in self.threads:
+                thread.join()
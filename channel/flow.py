@@ -0,0 +1,92 @@
+from collections import deque
+
+
+class WindowFull(Exception):
+    pass
+
+
+class FlowWindow(object):
+
+    def __init__(self, max_messages=64, max_bytes=0, min_messages=1,
+                 adaptive=True):
+        # a max_messages of 0 only limits bytes
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.min_messages = min_messages
+        self.adaptive = adaptive
+
+        # current window in messages, adapted to the observed ack latency
+        self.size = float(max_messages)
+        self.rtt = None
+
+        # message_id -> (bytes, time it was let through, None once it was
+        # retransmitted)
+        self.in_flight = {}
+        self.in_flight_bytes = 0
+        # (message_id, bytes) waiting for room
+        self.queue = deque()
+
+    def has_room(self, size=0):
+        if self.max_messages and len(self.in_flight) >= int(self.size):
+            return False
+
+        # a single message bigger than max_bytes still goes out on its own
+        if self.max_bytes and self.in_flight and self.in_flight_bytes + size > self.max_bytes:
+            return False
+
+        return True
+
+    def is_open(self, size=0):
+        return not self.queue and self.has_room(size)
+
+    def acquire(self, message_id, size, now):
+        self.in_flight[message_id] = (size, now)
+        self.in_flight_bytes += size
+
+    def enqueue(self, message_id, size):
+        # waits for room, drain() lets it through in order
+        self.queue.append((message_id, size))
+
+    def retransmit(self, message_id):
+        # Karn's rule, an ack can't tell which transmission it answers so
+        # retransmitted messages give no rtt sample
+        if message_id in self.in_flight:
+            self.in_flight[message_id] = (self.in_flight[message_id][0], None)
+
+    def release(self, message_id, now):
+        if message_id not in self.in_flight:
+            # still queued, e.g. it went dead before it was let through
+            self.queue = deque(entry for entry in self.queue
+                               if entry[0] != message_id)
+            return
+
+        size, started = self.in_flight.pop(message_id)
+        self.in_flight_bytes -= size
+
+        if self.adaptive and self.max_messages and started is not None:
+            self.adapt(now - started)
+
+    def adapt(self, sample):
+        # halve the window when acks take much longer than usual and grow
+        # it back by about one message per window of acks otherwise
+        if self.rtt is None:
+            self.rtt = sample
+            return
+
+        if sample > 2 * self.rtt:
+            self.size = max(self.min_messages, self.size / 2)
+        else:
+            self.size = min(self.max_messages, self.size + 1.0 / self.size)
+
+        self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+    def drain(self, now):
+        # lets queued messages through while there is room
+        released = []
+
+        while self.queue and self.has_room(self.queue[0][1]):
+            message_id, size = self.queue.popleft()
+            self.acquire(message_id, size, now)
+            released.append(message_id)
+
+        return released
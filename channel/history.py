@@ -0,0 +1,268 @@
+import bisect
+import json
+import sqlite3
+import time
+
+
+class HistoryStore(object):
+
+    # entries are dicts kept per key, e.g. a room or an identity, and
+    # numbered by a per key sequence starting at 1
+    def append(self, key, entry):
+        raise NotImplementedError()
+
+    def get_after(self, key, sequence, limit):
+        raise NotImplementedError()
+
+    def get_sequence_at(self, key, timestamp):
+        # the first sequence stored at or after timestamp, None if none
+        raise NotImplementedError()
+
+    def get_range(self, key, after=None, since=None, limit=100):
+        # returns (entries, more), pass the last entry's sequence as after
+        # to fetch the next page
+        if after is None:
+            after = 0
+
+            if since is not None:
+                sequence = self.get_sequence_at(key, since)
+
+                if sequence is None:
+                    return [], False
+
+                after = sequence - 1
+
+        entries = self.get_after(key, after, limit + 1)
+
+        return entries[:limit], len(entries) > limit
+
+    def new_entry(self, entry, sequence):
+        entry = dict(entry)
+        entry['sequence'] = sequence
+        entry.setdefault('timestamp', time.time())
+        return entry
+
+
+class MemoryHistoryStore(HistoryStore):
+
+    def __init__(self, max_entries=10000):
+        # only the last max_entries entries of every key are kept
+        self.max_entries = max_entries
+        self.entries = {}
+        self.sequences = {}
+
+    def append(self, key, entry):
+        sequence = self.sequences.get(key, 0) + 1
+        self.sequences[key] = sequence
+
+        entries = self.entries.setdefault(key, [])
+        entries.append(self.new_entry(entry, sequence))
+
+        # trimmed in chunks rather than on every append
+        if self.max_entries and len(entries) > self.max_entries * 1.1:
+            del entries[:len(entries) - self.max_entries]
+
+        return sequence
+
+    def get_after(self, key, sequence, limit):
+        entries = self.entries.get(key, [])
+
+        if not entries:
+            return []
+
+        # sequences are contiguous so the position is computed directly
+        start = max(0, sequence - entries[0]['sequence'] + 1)
+        return entries[start:start + limit]
+
+    def get_sequence_at(self, key, timestamp):
+        entries = self.entries.get(key, [])
+        timestamps = [entry['timestamp'] for entry in entries]
+        index = bisect.bisect_left(timestamps, timestamp)
+
+        if index == len(entries):
+            return None
+
+        return entries[index]['sequence']
+
+
+class SqliteHistoryStore(HistoryStore):
+
+    def __init__(self, path, max_entries=0):
+        # a local file, max_entries of 0 keeps everything, transactions are
+        # managed here so that processes sharing the file number entries
+        # one at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        self.max_entries = max_entries
+
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "key TEXT NOT NULL, sequence INTEGER NOT NULL, "
+            "timestamp REAL NOT NULL, entry TEXT NOT NULL, "
+            "PRIMARY KEY (key, sequence))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS history_timestamp "
+            "ON history (key, timestamp)")
+
+    def append(self, key, entry):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            row = self.connection.execute(
+                "SELECT MAX(sequence) FROM history WHERE key = ?",
+                (key,)).fetchone()
+            sequence = (row[0] or 0) + 1
+            entry = self.new_entry(entry, sequence)
+
+            self.connection.execute(
+                "INSERT INTO history (key, sequence, timestamp, entry) "
+                "VALUES (?, ?, ?, ?)",
+                (key, sequence, entry['timestamp'], json.dumps(entry)))
+
+            if self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM history WHERE key = ? AND sequence <= ?",
+                    (key, sequence - self.max_entries))
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        self.connection.execute("COMMIT")
+
+        return sequence
+
+    def get_after(self, key, sequence, limit):
+        rows = self.connection.execute(
+            "SELECT entry FROM history WHERE key = ? AND sequence > ? "
+            "ORDER BY sequence LIMIT ?", (key, sequence, limit))
+
+        return [json.loads(row[0]) for row in rows]
+
+    def get_sequence_at(self, key, timestamp):
+        row = self.connection.execute(
+            "SELECT MIN(sequence) FROM history WHERE key = ? AND timestamp >= ?",
+            (key, timestamp)).fetchone()
+
+        return row[0]
+
+
+class RedisHistoryStore(HistoryStore):
+
+    def __init__(self, redis_connection, name, max_entries=10000):
+        # per key, a sorted set of entries scored by sequence, one of
+        # sequences scored by timestamp and a counter
+        self.r = redis_connection
+        self.name = name
+        self.max_entries = max_entries
+
+    def get_key_name(self, key, suffix):
+        return "{}:{}:{}".format(self.name, key, suffix)
+
+    def append(self, key, entry):
+        sequence = self.r.incr(self.get_key_name(key, "sequence"))
+        entry = self.new_entry(entry, sequence)
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.zadd(self.get_key_name(key, "entries"), {json.dumps(entry): sequence})
+        pipe.zadd(self.get_key_name(key, "timestamps"), {sequence: entry['timestamp']})
+
+        if self.max_entries:
+            pipe.zremrangebyscore(self.get_key_name(key, "entries"), '-inf',
+                                  sequence - self.max_entries)
+            pipe.zremrangebyrank(self.get_key_name(key, "timestamps"), 0,
+                                 -self.max_entries - 1)
+
+        pipe.execute()
+
+        return sequence
+
+    def get_after(self, key, sequence, limit):
+        entries = self.r.zrangebyscore(self.get_key_name(key, "entries"),
+                                       "({}".format(sequence), '+inf',
+                                       start=0, num=limit)
+
+        return [json.loads(entry) for entry in entries]
+
+    def get_sequence_at(self, key, timestamp):
+        sequences = self.r.zrangebyscore(self.get_key_name(key, "timestamps"),
+                                         timestamp, '+inf', start=0, num=1)
+
+        if not sequences:
+            return None
+
+        return int(sequences[0])
+
+
+class HistoryClient(object):
+
+    def __init__(self, channel, destination, key, page_size=100,
+                 last_sequence=0):
+        # fetches what was missed from a server keeping a HistoryStore, a
+        # page at a time, and tells apart entries already seen live,
+        # last_sequence is the last one seen without gaps before it
+        self.channel = channel
+        self.destination = destination
+        self.key = key
+        self.page_size = page_size
+        self.last_sequence = last_sequence
+        self.seen = set()
+
+    def request(self, after=None):
+        if after is None:
+            after = self.last_sequence
+
+        self.channel.send(self.destination, None, extra_headers={
+            'type': 'HISTORY',
+            'key': self.key,
+            'after': after,
+            'limit': self.page_size
+        })
+
+    def is_new(self, sequence):
+        if sequence is None:
+            return True
+
+        if sequence <= self.last_sequence or sequence in self.seen:
+            return False
+
+        self.seen.add(sequence)
+
+        while self.last_sequence + 1 in self.seen:
+            self.last_sequence += 1
+            self.seen.remove(self.last_sequence)
+
+        return True
+
+    def handle(self, message):
+        # returns the new entries of a HISTORY reply, asking for the next
+        # page if there is one
+        data = message['data']
+
+        # entries trimmed from the store are skipped
+        if data['entries'] and data['after'] == self.last_sequence:
+            self.last_sequence = max(self.last_sequence,
+                                     data['entries'][0]['sequence'] - 1)
+
+        entries = [entry for entry in data['entries']
+                   if self.is_new(entry['sequence'])]
+
+        if data['more']:
+            self.request(data['entries'][-1]['sequence'])
+
+        return entries
+
+
+def get_history_reply(store, message, max_limit=500):
+    # the data answering a HISTORY request
+    headers = message['headers']
+    limit = min(int(headers.get('limit') or 100), max_limit)
+
+    entries, more = store.get_range(headers['key'], headers.get('after'),
+                                    headers.get('since'), limit)
+
+    return {
+        'key': headers['key'],
+        'after': headers.get('after'),
+        'entries': entries,
+        'more': more
+    }
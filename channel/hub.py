@@ -0,0 +1,271 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+import zmq
+
+from .channel import ReliableChannel
+from .shard import ShardSockets
+
+
+class ChannelHub(object):
+
+    def __init__(self, publish_to, receive_from, channel_factory=None,
+                 context=None):
+        # hosts any number of identities on one context, one PUB socket per
+        # shard and one SUB socket, channels are made by
+        # channel_factory(identity, publish_to, receive_from, hub=hub, ...)
+        # and may share e.g. one redis connection pool for their caches
+        self.context = context or zmq.Context.instance()
+        self.channel_factory = channel_factory or ReliableChannel
+
+        self.sockets = ShardSockets(self.context, publish_to, receive_from)
+        self.sockets.connect_receiver(set(self.sockets.shards.values()))
+
+        # topic -> channels subscribed to it, identity -> channel
+        self.subscriptions = {}
+        self.channels = OrderedDict()
+
+        # one lock for the shared sockets, channels use it as their own
+        self.lock = threading.RLock()
+        self.running = False
+
+        # heap of (deadline, count, channel), an entry is stale once its
+        # channel is scheduled under a newer count, channels that may have
+        # a new deadline wait in dirty until the next pass reads it
+        self.deadlines = []
+        self.scheduled = {}
+        self.dirty = set()
+        self.counter = itertools.count()
+
+        # other threads sending through the hub's channels wake it with this
+        address = "inproc://hub-wake-" + uuid.uuid4().hex
+
+        self.wake_receiver = self.context.socket(zmq.PAIR)
+        self.wake_receiver.bind(address)
+        self.wake_sender = self.context.socket(zmq.PAIR)
+        self.wake_sender.connect(address)
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.sockets.receiver, zmq.POLLIN)
+        self.poller.register(self.wake_receiver, zmq.POLLIN)
+
+    def create_channel(self, identity, **kwargs):
+        shards = self.sockets.shards
+        channel = self.channel_factory(identity, list(shards),
+                                       list(shards.values()), hub=self,
+                                       **kwargs)
+        self.channels[identity] = channel
+        self.wake(channel)
+
+        return channel
+
+    def remove_channel(self, identity):
+        channel = self.channels.pop(identity)
+
+        for group in list(channel.groups):
+            channel.leave(group)
+
+        channel.unsubscribe(identity + "::")
+
+        with self.lock:
+            self.scheduled.pop(channel, None)
+            self.dirty.discard(channel)
+
+        return channel
+
+    def subscribe(self, topic, channel):
+        # the socket subscribes once per topic, e.g. for a group joined by
+        # several channels
+        topic = topic.encode("utf-8")
+        channels = self.subscriptions.setdefault(topic, [])
+
+        if not channels:
+            self.sockets.receiver.setsockopt(zmq.SUBSCRIBE, topic)
+
+        if channel not in channels:
+            channels.append(channel)
+
+    def unsubscribe(self, topic, channel):
+        topic = topic.encode("utf-8")
+        channels = self.subscriptions.get(topic)
+
+        if channels is None or channel not in channels:
+            return
+
+        channels.remove(channel)
+
+        if not channels:
+            del self.subscriptions[topic]
+            self.sockets.receiver.setsockopt(zmq.UNSUBSCRIBE, topic)
+
+    def add_shard(self, publish_to, receive_from):
+        self.sockets.add_shard(publish_to, receive_from)
+        self.sockets.connect_receiver(set(self.sockets.shards.values()))
+
+    def remove_shard(self, publish_to):
+        self.sockets.remove_shard(publish_to)
+        self.sockets.connect_receiver(set(self.sockets.shards.values()))
+
+        if self.sockets.shards:
+            for channel in self.channels.values():
+                channel.sender = self.sockets.get_first_sender()
+
+    def get_topic(self, frame):
+        # multipart messages have a topic frame of their own, older single
+        # frame ones start with it
+        return frame.bytes.split(b"::", 1)[0] + b"::"
+
+    def receive_many(self, max_messages=1000):
+        # reads what is waiting and hands it to the channels it is for,
+        # returns the channels that got something
+        received = OrderedDict()
+
+        for _ in range(max_messages):
+            try:
+                frames = self.sockets.receiver.recv_multipart(zmq.DONTWAIT,
+                                                              copy=False)
+            except zmq.Again:
+                break
+
+            for channel in self.subscriptions.get(self.get_topic(frames[0]), ()):
+                received.setdefault(channel, []).append(frames)
+
+        for channel, messages in received.items():
+            channel.handle(messages)
+
+        with self.lock:
+            self.dirty.update(received)
+
+        return received
+
+    def wake(self, channel):
+        # channel may have a new deadline, e.g. after a send from another
+        # thread, the first one marked since the last pass wakes the hub
+        with self.lock:
+            if not self.dirty:
+                try:
+                    self.wake_sender.send(b"", zmq.DONTWAIT)
+                except zmq.Again:
+                    pass
+
+            self.dirty.add(channel)
+
+    def drain_wakes(self):
+        while True:
+            try:
+                self.wake_receiver.recv(zmq.DONTWAIT)
+            except zmq.Again:
+                return
+
+    def reschedule(self):
+        # reads the deadlines of the marked channels only, called with the
+        # lock held
+        for channel in self.dirty:
+            if self.channels.get(channel.identity) is not channel:
+                continue
+
+            deadline = channel.get_next_deadline()
+            entry = self.scheduled.get(channel)
+
+            if deadline is None:
+                self.scheduled.pop(channel, None)
+            elif entry is None or entry[0] != deadline:
+                count = next(self.counter)
+                self.scheduled[channel] = (deadline, count)
+                heapq.heappush(self.deadlines, (deadline, count, channel))
+
+        self.dirty.clear()
+
+        # stale entries of channels rescheduled further out pile up until
+        # they reach the top, drop them once they outnumber the live ones
+        if len(self.deadlines) > 2 * len(self.scheduled) + 64:
+            self.deadlines = [(deadline, count, channel)
+                              for deadline, count, channel in self.deadlines
+                              if self.scheduled.get(channel) == (deadline, count)]
+            heapq.heapify(self.deadlines)
+
+    def get_next_deadline(self):
+        with self.lock:
+            self.reschedule()
+
+            while self.deadlines:
+                deadline, count, channel = self.deadlines[0]
+
+                if self.scheduled.get(channel) == (deadline, count):
+                    return deadline
+
+                heapq.heappop(self.deadlines)
+
+        return None
+
+    def pop_due(self, now):
+        # channels whose deadline has passed, called with the lock held
+        due = []
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, count, channel = heapq.heappop(self.deadlines)
+
+            if self.scheduled.get(channel) == (deadline, count):
+                del self.scheduled[channel]
+                due.append(channel)
+
+        return due
+
+    def run_due(self, received=()):
+        # channels that received something or have something due
+        now = time.time()
+        due = OrderedDict.fromkeys(received)
+
+        with self.lock:
+            self.reschedule()
+
+            for channel in self.pop_due(now):
+                due[channel] = None
+
+        for channel in due:
+            channel.run_due()
+
+        with self.lock:
+            self.dirty.update(due)
+
+    def run_once(self, timeout=None, max_messages=1000):
+        deadline = self.get_next_deadline()
+
+        if deadline is not None:
+            due = max(0, deadline - time.time())
+            timeout = due if timeout is None else min(timeout, due)
+
+        if timeout is not None:
+            timeout = max(0, int(math.ceil(timeout * 1000)))
+
+        events = dict(self.poller.poll(timeout))
+
+        if events.get(self.wake_receiver) == zmq.POLLIN:
+            self.drain_wakes()
+
+        received = ()
+
+        if events.get(self.sockets.receiver) == zmq.POLLIN:
+            received = self.receive_many(max_messages)
+
+        self.run_due(received)
+
+    def run_forever(self, timeout=None, max_messages=1000):
+        self.running = True
+
+        while self.running:
+            self.run_once(timeout, max_messages)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.sockets.close()
+        self.wake_receiver.close()
+        self.wake_sender.close()
@@ -0,0 +1,87 @@
+import time
+
+
+class PresenceRegistry(object):
+
+    def __init__(self, timeout=30):
+        # identity -> time it was last heard from, identities not heard
+        # from for timeout seconds are taken offline by expire()
+        self.timeout = timeout
+        self.last_seen = {}
+        self.callbacks = []
+
+    def register_callback(self, callback):
+        # called with (identity, online) whenever an identity comes or goes
+        self.callbacks.append(callback)
+
+    def notify(self, identity, online):
+        for callback in self.callbacks:
+            callback(identity, online)
+
+    def touch(self, identity, now=None):
+        online = identity not in self.last_seen
+        self.last_seen[identity] = now or time.time()
+
+        if online:
+            self.notify(identity, True)
+
+    def join(self, identity, now=None):
+        self.touch(identity, now)
+
+    def leave(self, identity):
+        if self.last_seen.pop(identity, None) is not None:
+            self.notify(identity, False)
+
+    def is_online(self, identity):
+        return identity in self.last_seen
+
+    def get_online(self, identities=None):
+        if identities is None:
+            return list(self.last_seen)
+
+        return [identity for identity in identities
+                if identity in self.last_seen]
+
+    def expire(self, now=None):
+        now = now or time.time()
+
+        expired = [identity for identity, seen in self.last_seen.items()
+                   if now - seen > self.timeout]
+
+        for identity in expired:
+            self.leave(identity)
+
+        return expired
+
+
+class Heartbeat(object):
+
+    def __init__(self, channel, destination, interval=10):
+        # keeps a client present on a server, the server's registry timeout
+        # should be a few intervals
+        self.channel = channel
+        self.destination = destination
+        self.interval = interval
+        self.last_beat = None
+
+    def send(self, message_type, now=None):
+        # returns what the channel does, e.g. a coroutine to await for an
+        # async one
+        sent = self.channel.send_control(self.destination, message_type)
+        self.last_beat = now or time.time()
+
+        return sent
+
+    def join(self):
+        return self.send('JOIN')
+
+    def leave(self):
+        return self.send('LEAVE')
+
+    def beat(self, now=None):
+        now = now or time.time()
+
+        if self.last_beat is None or now - self.last_beat >= self.interval:
+            return self.send('HEARTBEAT', now)
+
+        return None
@@ -0,0 +1,236 @@
+import heapq
+import itertools
+import random
+import time
+
+
+def to_text(value):
+    # redis replies are bytes unless the connection decodes responses
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+
+    return value
+
+
+class RetryScheduler(object):
+
+    def __init__(self, initial_rto=1, backoff=2, max_rto=60, jitter=0.1,
+                 max_attempts=0):
+        self.initial_rto = float(initial_rto)
+        self.backoff = float(backoff)
+        self.max_rto = float(max_rto)
+        self.jitter = float(jitter)
+        self.max_attempts = int(max_attempts)
+
+        # heap of (deadline, order, message_id), entries that no longer
+        # match `scheduled` are stale and skipped when popped, order keeps
+        # messages with the same deadline first in first out
+        self.deadlines = []
+        self.scheduled = {}
+        self.order = itertools.count()
+
+    def get_timeout(self, attempts):
+        timeout = min(self.initial_rto * (self.backoff ** attempts),
+                      self.max_rto)
+
+        if self.jitter:
+            timeout += timeout * random.uniform(-self.jitter, self.jitter)
+
+        return max(0, timeout)
+
+    def schedule(self, message_id, deadline=None, attempts=0):
+        if deadline is None:
+            deadline = time.time()
+
+        self.scheduled[message_id] = (deadline, attempts)
+        heapq.heappush(self.deadlines, (deadline, next(self.order), message_id))
+
+    def retry_later(self, message_id, attempts, now=None):
+        if now is None:
+            now = time.time()
+
+        self.schedule(message_id, now + self.get_timeout(attempts - 1),
+                      attempts)
+
+    def schedule_new(self, message_ids, deadline=None):
+        # schedules only the messages that aren't scheduled already
+        for message_id in message_ids:
+            if message_id not in self.scheduled:
+                self.schedule(message_id, deadline)
+
+    def retry_many_later(self, retries, now=None):
+        # retries is [(message_id, attempts)]
+        for message_id, attempts in retries:
+            self.retry_later(message_id, attempts, now)
+
+    def retry_now(self, message_ids, now=None):
+        # brings already scheduled messages forward, keeping their attempts
+        if now is None:
+            now = time.time()
+
+        for message_id in message_ids:
+            if message_id in self.scheduled:
+                self.schedule(message_id, now, self.scheduled[message_id][1])
+
+    def cancel(self, message_id):
+        self.scheduled.pop(message_id, None)
+
+    def cancel_many(self, message_ids):
+        for message_id in message_ids:
+            self.cancel(message_id)
+
+    def is_scheduled(self, message_id):
+        return message_id in self.scheduled
+
+    def load(self):
+        # reads back what was scheduled before a restart where it is kept
+        pass
+
+    def flush(self):
+        # writes out what changed since the last flush where it is kept
+        pass
+
+    def is_exhausted(self, attempts):
+        return bool(self.max_attempts) and attempts >= self.max_attempts
+
+    def get_next_deadline(self):
+        while self.deadlines:
+            deadline, _, message_id = self.deadlines[0]
+            entry = self.scheduled.get(message_id)
+
+            if entry is not None and entry[0] == deadline:
+                return deadline
+
+            heapq.heappop(self.deadlines)
+
+        return None
+
+    def get_due(self, now=None, limit=None):
+        # returns [(message_id, attempts)], the caller is expected to
+        # either retry_later or cancel every one of them
+        if now is None:
+            now = time.time()
+
+        due = []
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            if limit and len(due) >= limit:
+                break
+
+            deadline, _, message_id = heapq.heappop(self.deadlines)
+            entry = self.scheduled.get(message_id)
+
+            if entry is None or entry[0] != deadline:
+                continue
+
+            due.append((message_id, entry[1]))
+
+        return due
+
+
+class RedisRetryScheduler(RetryScheduler):
+
+    def __init__(self, redis_connection, name, **kwargs):
+        # deadlines live in a sorted set so that they survive restarts and
+        # due messages are found with a range by score
+        super(RedisRetryScheduler, self).__init__(**kwargs)
+
+        self.r = redis_connection
+        self.name = name
+        self.attempts_name = name + "_attempts"
+
+    def schedule(self, message_id, deadline=None, attempts=0):
+        if deadline is None:
+            deadline = time.time()
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.zadd(self.name, {message_id: deadline})
+        pipe.hset(self.attempts_name, message_id, attempts)
+        pipe.execute()
+
+    def get_deadlines(self, message_ids, deadline):
+        # members with equal scores are ordered by id, spreading them by a
+        # microsecond keeps them in the given order
+        return dict((message_id, deadline + index * 1e-6)
+                    for index, message_id in enumerate(message_ids))
+
+    def schedule_new(self, message_ids, deadline=None):
+        if not message_ids:
+            return
+
+        if deadline is None:
+            deadline = time.time()
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.zadd(self.name, self.get_deadlines(message_ids, deadline), nx=True)
+        for message_id in message_ids:
+            pipe.hsetnx(self.attempts_name, message_id, 0)
+        pipe.execute()
+
+    def retry_many_later(self, retries, now=None):
+        if not retries:
+            return
+
+        if now is None:
+            now = time.time()
+
+        deadlines = dict((message_id, now + self.get_timeout(attempts - 1))
+                         for message_id, attempts in retries)
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.zadd(self.name, deadlines)
+        for message_id, attempts in retries:
+            pipe.hset(self.attempts_name, message_id, attempts)
+        pipe.execute()
+
+    def retry_later(self, message_id, attempts, now=None):
+        self.retry_many_later([(message_id, attempts)], now)
+
+    def retry_now(self, message_ids, now=None):
+        if not message_ids:
+            return
+
+        if now is None:
+            now = time.time()
+
+        self.r.zadd(self.name, self.get_deadlines(message_ids, now), xx=True)
+
+    def cancel(self, message_id):
+        self.cancel_many([message_id])
+
+    def cancel_many(self, message_ids):
+        if not message_ids:
+            return
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.zrem(self.name, *message_ids)
+        pipe.hdel(self.attempts_name, *message_ids)
+        pipe.execute()
+
+    def is_scheduled(self, message_id):
+        return self.r.zscore(self.name, message_id) is not None
+
+    def get_next_deadline(self):
+        first = self.r.zrange(self.name, 0, 0, withscores=True)
+
+        if not first:
+            return None
+
+        return first[0][1]
+
+    def get_due(self, now=None, limit=None):
+        if now is None:
+            now = time.time()
+
+        if limit:
+            message_ids = self.r.zrangebyscore(self.name, '-inf', now, start=0, num=limit)
+        else:
+            message_ids = self.r.zrangebyscore(self.name, '-inf', now)
+
+        if not message_ids:
+            return []
+
+        attempts = self.r.hmget(self.attempts_name, *message_ids)
+
+        return [(to_text(message_id), int(attempt or 0))
+                for message_id, attempt in zip(message_ids, attempts)]
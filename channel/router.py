@@ -0,0 +1,165 @@
+import json
+import time
+
+import zmq
+
+
+class Router(object):
+
+    def __init__(self, frontend, backend, stats=None, hwm=1000,
+                 stats_interval=1.0, context=None):
+        # publishers connect to the frontend and subscribers to the backend,
+        # subscriptions travel upstream so that publishers filter at source,
+        # a router runs on one thread since its sockets can't be shared, more
+        # throughput comes from more router shards
+        self.context = context or zmq.Context.instance()
+        self.frontend = self.context.socket(zmq.XSUB)
+        self.backend = self.context.socket(zmq.XPUB)
+
+        for socket in (self.frontend, self.backend):
+            socket.setsockopt(zmq.SNDHWM, hwm)
+            socket.setsockopt(zmq.RCVHWM, hwm)
+
+        # sends fail while a subscriber is at its hwm so that the drop can
+        # be counted, see forward()
+        self.backend.setsockopt(zmq.XPUB_NODROP, 1)
+
+        self.frontend.bind(frontend)
+        self.backend.bind(backend)
+
+        self.stats = None
+        if stats:
+            self.stats = self.context.socket(zmq.PUB)
+            self.stats.bind(stats)
+
+        self.stats_interval = stats_interval
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.frontend, zmq.POLLIN)
+        self.poller.register(self.backend, zmq.POLLIN)
+
+        self.callbacks = []
+        self.running = False
+        self.reset_counters()
+        self.last_report = time.time()
+
+    def register_callback(self, callback):
+        # called with every stats report
+        self.callbacks.append(callback)
+
+    def reset_counters(self):
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.topics = {}
+        self.subscriptions = 0
+
+    def get_topic(self, frames):
+        topic = frames[0].split(b"::", 1)[0]
+        return topic.decode("utf-8", "replace")
+
+    def forward(self, max_messages=1000):
+        # drains what is waiting instead of polling for every message
+        for _ in range(max_messages):
+            try:
+                frames = self.frontend.recv_multipart(zmq.DONTWAIT)
+            except zmq.Again:
+                return
+
+            topic = self.get_topic(frames)
+
+            try:
+                self.backend.send_multipart(frames, zmq.DONTWAIT)
+            except zmq.Again:
+                # a subscriber at its hwm misses the message while the others
+                # still get it, reliable channels resend what it missed
+                self.dropped += 1
+                self.send_lossy(frames)
+
+            self.messages += 1
+            self.bytes += sum(len(frame) for frame in frames)
+            self.topics[topic] = self.topics.get(topic, 0) + 1
+
+    def send_lossy(self, frames):
+        # libzmq reads the option on every send, without it the message goes
+        # to every subscriber with room
+        self.backend.setsockopt(zmq.XPUB_NODROP, 0)
+
+        try:
+            self.backend.send_multipart(frames)
+        finally:
+            self.backend.setsockopt(zmq.XPUB_NODROP, 1)
+
+    def subscribe(self):
+        # (un)subscriptions from subscribers go up to the publishers
+        while True:
+            try:
+                frames = self.backend.recv_multipart(zmq.DONTWAIT)
+            except zmq.Again:
+                return
+
+            self.frontend.send_multipart(frames)
+            self.subscriptions += 1
+
+    def get_stats(self, now):
+        elapsed = max(now - self.last_report, 1e-9)
+
+        return {
+            'timestamp': now,
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'messages_per_second': self.messages / elapsed,
+            'bytes_per_second': self.bytes / elapsed,
+            'dropped': self.dropped,
+            'subscriptions': self.subscriptions,
+            'topics': self.topics
+        }
+
+    def report(self, now):
+        stats = self.get_stats(now)
+
+        if self.stats is not None:
+            self.stats.send_string(json.dumps(stats))
+
+        for callback in self.callbacks:
+            callback(stats)
+
+        self.reset_counters()
+        self.last_report = now
+
+        return stats
+
+    def run_once(self, timeout=None):
+        # timeout in seconds, stats go out every stats_interval regardless
+        now = time.time()
+        due = max(0, self.last_report + self.stats_interval - now)
+
+        if timeout is None or timeout > due:
+            timeout = due
+
+        events = dict(self.poller.poll(int(timeout * 1000)))
+
+        if events.get(self.backend) == zmq.POLLIN:
+            self.subscribe()
+
+        if events.get(self.frontend) == zmq.POLLIN:
+            self.forward()
+
+        now = time.time()
+
+        if now - self.last_report >= self.stats_interval:
+            self.report(now)
+
+    def run_forever(self):
+        self.running = True
+
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        for socket in (self.frontend, self.backend, self.stats):
+            if socket is not None:
+                socket.close()
@@ -0,0 +1,67 @@
+class SequenceTracker(object):
+
+    def __init__(self, session, max_missing=1000, max_requests=10):
+        # tracks the sequence numbers received from one peer session,
+        # sequences start at 1, a sequence requested max_requests times is
+        # given up on since the sender can't resend it, e.g. it went dead
+        self.session = session
+        self.max_missing = max_missing
+        self.max_requests = max_requests
+        self.next_sequence = 1
+        self.received = set()
+        # missing sequence -> (time it was last requested, 0 if never, times
+        # it was requested)
+        self.missing = {}
+
+    def receive(self, sequence, base=None):
+        if base and base > self.next_sequence:
+            # the sender has everything below base confirmed already
+            self.next_sequence = base
+            self.received = set(received for received in self.received
+                                if received >= base)
+            self.missing = dict((missing, requested) for missing, requested
+                                in self.missing.items() if missing >= base)
+
+        if sequence >= self.next_sequence:
+            self.missing.pop(sequence, None)
+
+            if sequence > self.next_sequence:
+                self.received.add(sequence)
+
+                start = max(self.next_sequence, sequence - self.max_missing)
+                for missing in range(start, sequence):
+                    if missing not in self.received and missing not in self.missing:
+                        self.missing[missing] = (0, 0)
+            else:
+                self.next_sequence += 1
+
+        self.skip_received()
+
+    def skip_received(self):
+        while self.next_sequence in self.received:
+            self.received.remove(self.next_sequence)
+            self.next_sequence += 1
+
+    def has_gaps(self):
+        return bool(self.missing)
+
+    def get_missing(self, now, interval):
+        # sequences due to be requested again, marked as requested now
+        missing = []
+
+        for sequence, (requested, requests) in sorted(self.missing.items()):
+            if now - requested < interval:
+                continue
+
+            if self.max_requests and requests >= self.max_requests:
+                # moves past it like a received one
+                del self.missing[sequence]
+                self.received.add(sequence)
+                continue
+
+            self.missing[sequence] = (now, requests + 1)
+            missing.append(sequence)
+
+        self.skip_received()
+
+        return missing
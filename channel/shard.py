@@ -0,0 +1,123 @@
+import bisect
+import hashlib
+
+from collections import OrderedDict
+
+import zmq
+
+
+def get_shards(publish_to, receive_from):
+    # publish_to and receive_from are one router's locations or lists of
+    # router shards, returns publish location -> receive location in order
+    if not isinstance(publish_to, (list, tuple)):
+        publish_to = [publish_to]
+
+    if not isinstance(receive_from, (list, tuple)):
+        receive_from = [receive_from]
+
+    if len(publish_to) != len(receive_from):
+        raise ValueError("{} publish locations for {} receive locations".format(
+            len(publish_to), len(receive_from)))
+
+    return OrderedDict(zip(publish_to, receive_from))
+
+
+class HashRing(object):
+
+    def __init__(self, nodes=None, replicas=100):
+        # every node sits at `replicas` points on the ring and a key belongs
+        # to the first point after its hash, adding or removing a node only
+        # moves the keys next to that node's points
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+
+        for node in nodes or []:
+            self.add_node(node)
+
+    def get_hash(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_points(self, node):
+        return [self.get_hash("{}#{}".format(node, replica))
+                for replica in range(self.replicas)]
+
+    def add_node(self, node):
+        for point in self.get_points(node):
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+
+            self.owners[point] = node
+
+    def remove_node(self, node):
+        for point in self.get_points(node):
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                self.points.pop(bisect.bisect_left(self.points, point))
+
+    def get_nodes(self):
+        return set(self.owners.values())
+
+    def get_node(self, key):
+        if not self.points:
+            return None
+
+        index = bisect.bisect(self.points, self.get_hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+class ShardSockets(object):
+
+    def __init__(self, context, publish_to, receive_from):
+        # one PUB socket per router shard and one SUB socket, owned by a
+        # channel or shared by the channels of a hub
+        self.context = context
+        self.shards = OrderedDict()
+        self.ring = HashRing()
+        self.senders = {}
+        self.receiver = context.socket(zmq.SUB)
+        self.receive_from = set()
+
+        for shard, shard_receive_from in get_shards(publish_to, receive_from).items():
+            self.add_shard(shard, shard_receive_from)
+
+    def get_owner(self, name):
+        # the receive location of the shard owning an identity or group
+        return self.shards[self.ring.get_node(name)]
+
+    def get_first_sender(self):
+        # the first shard's socket, the only one without sharding
+        return self.senders[next(iter(self.shards))]
+
+    def add_shard(self, publish_to, receive_from):
+        sender = self.context.socket(zmq.PUB)
+        sender.connect(publish_to)
+        self.senders[publish_to] = sender
+
+        self.shards[publish_to] = receive_from
+        self.ring.add_node(publish_to)
+
+    def remove_shard(self, publish_to):
+        # the receiver stays connected until connect_receiver() is told
+        # what is wanted now
+        self.ring.remove_node(publish_to)
+        del self.shards[publish_to]
+        self.senders.pop(publish_to).close()
+
+    def connect_receiver(self, wanted):
+        for receive_from in self.receive_from - wanted:
+            self.receiver.disconnect(receive_from)
+
+        for receive_from in wanted - self.receive_from:
+            self.receiver.connect(receive_from)
+
+        self.receive_from = wanted
+
+    def close(self):
+        self.receiver.close()
+
+        for sender in self.senders.values():
+            sender.close()
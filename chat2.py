@@ -6,7 +6,8 @@ import redis
 import win
 
 from channel import (ReliableChannel, OrderedRedisMessageCache,
-                     RedisDeadMessageBackend)
+                     RedisDeadMessageBackend, RedisDeduplicator, Heartbeat,
+                     HistoryClient)
 # CONSTANTS
 prompt_string = ">> "
 start_row = 2
@@ -52,16 +53,23 @@ subscribe_from = 'tcp://localhost:5557'
 
 identity = sys.argv[1]
 server_identity = sys.argv[2]
+room = None
 
 if len(sys.argv) > 4:
-    publish_to = sys.argv[3]
-    subscribe_from = sys.argv[4]
+    # comma separated lists of router shards
+    publish_to = sys.argv[3].split(",")
+    subscribe_from = sys.argv[4].split(",")
+
+if len(sys.argv) > 5:
+    room = sys.argv[5]
 
 
 r = redis.StrictRedis(host='localhost', port=6379, db=0)
+deduplicator = RedisDeduplicator(r, identity + "_seen")
 message_cache = OrderedRedisMessageCache(r,
                                          identity + "_sent2",
-                                         identity + "_received3")
+                                         identity + "_received3",
+                                         deduplicator=deduplicator)
 
 dead_backend = RedisDeadMessageBackend(r, identity + "_dead2")
 
@@ -71,14 +79,27 @@ channel = ReliableChannel(identity, publish_to, subscribe_from,
                           send_expiry=2 * 60 * 60,  # 2 hours
                           acknowledge_expiry=2 * 60 * 60)  # 2 hours
 
+if room:
+    channel.join(room)
+
+heartbeat = Heartbeat(channel, server_identity)
+heartbeat.join()
+
+# what was missed while away is fetched from the server's history
+last_sequence = int(r.get(identity + "_history") or 0)
+history = HistoryClient(channel, server_identity, room or server_identity,
+                        last_sequence=last_sequence)
+history.request()
+
 logger.info("Finished server connection setup")
 
 chat_win = win.ChatWin(">> ")
 
 
 def listen_for_server_updates(win):
-    channel.receive()
-    channel.synchronize()
+    # wait briefly for server updates so the ui loop doesn't spin
+    channel.run_once(0.05)
+    heartbeat.beat()
 
 
 def enter(win, current_input):
@@ -88,7 +109,25 @@ def enter(win, current_input):
 
 
 def received_message(message):
-    chat_win.show_message(message['headers']['source'] + ": " + message['data'])
+    if message['headers'].get('type') == 'HISTORY':
+        for entry in history.handle(message):
+            show_message(entry['author'], entry['data'])
+    elif message['headers'].get('type') == 'SEQUENCE':
+        # where our own message went in the history
+        history.is_new(message['headers']['history_sequence'])
+    elif history.is_new(message['headers'].get('history_sequence')):
+        show_message(message['headers'].get('author', message['headers']['source']),
+                     message['data'])
+
+    r.set(identity + "_history", history.last_sequence)
+
+
+def show_message(author, data):
+    # room messages come back to their author too
+    if author == identity:
+        return
+
+    chat_win.show_message(author + ": " + data)
 
 chat_win.add_event_listener("LOOP_RUN", listen_for_server_updates)
 chat_win.add_event_listener("ENTER", enter)
@@ -97,3 +136,4 @@ channel.register_callback(received_message)
 
 # EVENT LOOP
 chat_win.run()
+heartbeat.leave()
@@ -1,32 +1,49 @@
-import zmq
-import sys
+import argparse
+import json
+
+from channel.router import Router
 
 sub_port = 5556
 pub_port = 5557
 
-if len(sys.argv) > 2:
-    sub_port = sys.argv[1]
-    pub_port = sys.argv[2]
-
-subscribe_to = "tcp://*:{}".format(sub_port)
-publish_to = "tcp://*:{}".format(pub_port)
-
-try:
-    context = zmq.Context()
-    frontend = context.socket(zmq.SUB)
-    frontend.bind(subscribe_to)
-    frontend.setsockopt(zmq.SUBSCRIBE, "")
-
-    backend = context.socket(zmq.PUB)
-    backend.bind(publish_to)
-
-    zmq.device(zmq.FORWARDER, frontend, backend)
-except KeyboardInterrupt:
-    print "Bye!"
-except Exception:
-    print "Bringing down FORWARDER"
-    raise
-finally:
-    frontend.close()
-    backend.close()
-    context.term()
+
+def print_stats(stats):
+    print json.dumps(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("sub_port", nargs="?", default=sub_port,
+                        help="port publishers connect to")
+    parser.add_argument("pub_port", nargs="?", default=pub_port,
+                        help="port subscribers connect to")
+    parser.add_argument("--hwm", type=int, default=1000,
+                        help="high water mark of the router sockets")
+    parser.add_argument("--stats",
+                        help="location to publish stats on, e.g. tcp://*:5558")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between stats reports")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print stats reports")
+
+    args = parser.parse_args()
+
+    router = Router("tcp://*:{}".format(args.sub_port),
+                    "tcp://*:{}".format(args.pub_port),
+                    stats=args.stats, hwm=args.hwm,
+                    stats_interval=args.interval)
+
+    if args.verbose:
+        router.register_callback(print_stats)
+
+    try:
+        router.run_forever()
+    except KeyboardInterrupt:
+        print "Bye!"
+    finally:
+        router.close()
+
+
+if __name__ == "__main__":
+    main()
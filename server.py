@@ -1,61 +1,223 @@
 import argparse
+import functools
+import threading
 
-from channel import ReliableChannel
+from channel import (ReliableChannel, KeyedExecutor, WorkerPool,
+                     PresenceRegistry, MemoryHistoryStore, SqliteHistoryStore,
+                     get_history_reply)
+from channel.cluster import get_worker_identity
 
 publish_to = 'tcp://localhost:5556'
 subscribe_to = 'tcp://localhost:5557'
 
 client_identities = []
+room = None
+workers = 0
+presence_timeout = 30
+history_path = None
+history_key = None
 
 channel = None
+presence = None
+history = None
+
+# the other worker processes and the clients they have online, workers
+# tell each other when one of their clients comes or goes
+peers = []
+remote_online = set()
+
+lock = threading.RLock()
 
 
 def on_message(message):
     print "Received: {}".format(message)
     source = message['headers']['source']
-    rest_of_the_message = message['data']
+    message_type = message['headers'].get('type')
 
-    for client in client_identities:
-        if client != source:
-            channel.send(client, rest_of_the_message,
-                         extra_headers={"source": source})
+    with lock:
+        presence.expire()
 
+        if message_type == 'PRESENCE':
+            on_remote_presence(message['data'])
+            return
 
-def server(args):
-    global channel, client_identities, publish_to, subscribe_to
-    if args.publish_to:
-        publish_to = args.publish_to
+        if message_type == 'LEAVE':
+            presence.leave(source)
+            return
 
-    if args.subscribe_to:
-        subscribe_to = args.subscribe_to
+        presence.touch(source)
+
+        if message_type in ('JOIN', 'HEARTBEAT'):
+            return
+
+        if message_type == 'HISTORY':
+            channel.send(source, get_history_reply(history, message),
+                         extra_headers={"type": "HISTORY"})
+            return
+
+        fan_out(source, message['data'])
+
+
+def fan_out(source, data):
+    sequence = history.append(history_key, {"author": source, "data": data})
+
+    # the original author goes in its own header, clients ack whoever is
+    # in source
+    headers = {"author": source, "history_sequence": sequence}
+
+    online = [client for client in presence.get_online(client_identities or None)
+              if client != source]
+    online += [client for client in sorted(remote_online)
+               if client != source and client not in online
+               and (not client_identities or client in client_identities)]
+
+    if room:
+        # the author is in the room and gets the sequence with the message
+        channel.send_to_group(room, online, data, extra_headers=headers)
+        return
+
+    # the author only needs to know where its message is in the history so
+    # that it doesn't fetch it again
+    channel.send(source, None, extra_headers={"type": "SEQUENCE",
+                                              "history_sequence": sequence})
+
+    for client in online:
+        channel.send(client, data, extra_headers=headers)
+
+
+def on_presence(client, online):
+    # offline clients fetch what they missed from the history when they
+    # join again instead of having it retransmitted until it expires
+    if not online:
+        channel.drop_destination(client)
+
+    for peer in peers:
+        channel.send(peer, {"client": client, "online": online},
+                     extra_headers={"type": "PRESENCE"})
+
+
+def on_remote_presence(change):
+    # a client of another worker came or went, this worker sends to it too
+    client = change['client']
+
+    if change['online']:
+        remote_online.add(client)
+        return
+
+    remote_online.discard(client)
 
+    if not presence.is_online(client):
+        channel.drop_destination(client)
+
+
+def configure(args):
+    global client_identities, room, workers, presence_timeout, history_path
+    global history_key
     client_identities = args.client_identities
+    room = args.room
+    workers = args.workers
+    presence_timeout = args.presence_timeout
+    history_path = args.history
+    history_key = room or args.server_identity
 
-    channel = ReliableChannel(args.server_identity, publish_to, subscribe_to)
-    channel.register_callback(on_message)
 
-    while True:
+def server(args):
+    global publish_to, subscribe_to
+    if args.publish_to:
+        publish_to = args.publish_to.split(",")
+
+    if args.subscribe_to:
+        subscribe_to = args.subscribe_to.split(",")
+
+    if args.processes > 1:
+        # every process handles the clients hashing to it under its own
+        # identity, the server identity is only used to reach the dispatcher,
+        # the arguments go along with the factory since processes started
+        # with spawn don't inherit this module's globals
+        pool = WorkerPool(args.server_identity, publish_to, subscribe_to,
+                          workers=args.processes,
+                          channel_factory=functools.partial(create_channel, args),
+                          tick=expire_presence)
         try:
-            channel.receive()
-            channel.synchronize()
+            pool.run_forever()
         except KeyboardInterrupt:
             print "Bye!"
-            break
+        return
+
+    create_channel(args, args.server_identity, publish_to, subscribe_to)
+
+    try:
+        while True:
+            channel.run_once(1)
+            expire_presence(channel)
+    except KeyboardInterrupt:
+        print "Bye!"
+
+
+def expire_presence(channel):
+    # clients that stopped sending heartbeats go offline even when nothing
+    # else arrives
+    with lock:
+        presence.expire()
+
+
+def create_channel(args, identity, publish_to, subscribe_to):
+    global channel, presence, history, peers
+    configure(args)
+
+    if args.processes > 1:
+        peers = [get_worker_identity(args.server_identity, index)
+                 for index in range(args.processes)]
+        peers.remove(identity)
+
+    channel = ReliableChannel(identity, publish_to, subscribe_to)
+    channel.register_callback(on_message)
+
+    presence = PresenceRegistry(presence_timeout)
+    presence.register_callback(on_presence)
+
+    if history_path:
+        history = SqliteHistoryStore(history_path)
+    else:
+        history = MemoryHistoryStore()
+
+    if workers:
+        channel.set_executor(KeyedExecutor(workers))
+
+    return channel
 
 
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-p", "--publish_to",
-                        help="location to publish messages")
+                        help="location to publish messages, comma separated for shards")
     parser.add_argument("-s", "--subscribe_to",
-                        help="location to subscribe messages")
+                        help="location to subscribe messages, comma separated for shards")
+    parser.add_argument("-r", "--room",
+                        help="send to the clients through this group topic")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="handle messages on this many threads")
+    parser.add_argument("-n", "--processes", type=int, default=1,
+                        help="partition clients over this many processes")
+    parser.add_argument("-t", "--presence_timeout", type=float, default=30,
+                        help="seconds without a heartbeat before a client is offline")
+    parser.add_argument("--history",
+                        help="sqlite file to keep the history in, memory if not given, "
+                             "required with --processes")
     parser.add_argument("server_identity",
                         help="the identity of this server")
-    parser.add_argument("client_identities", nargs="+",
-                        help="list of client identities to coordinate")
+    parser.add_argument("client_identities", nargs="*",
+                        help="only send to these clients if given")
 
     args = parser.parse_args()
+
+    # every process numbers the history on its own with a memory store,
+    # clients would drop live messages as already seen and catch up on
+    # one process' share only
+    if args.processes > 1 and not args.history:
+        parser.error("--processes needs a --history file they share")
+
     server(args)
 
 
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+import zmq
+
+from channel.codec import decode
+from channel.router import Router
+
+
+def get_endpoint(socket):
+    endpoint = socket.getsockopt(zmq.LAST_ENDPOINT)
+    return endpoint.decode("utf-8")
+
+
+@pytest.fixture
+def router():
+    # a router on random local ports, run on a thread of its own, yields
+    # the (publish_to, receive_from) pair channels connect to
+    router = Router("tcp://127.0.0.1:*", "tcp://127.0.0.1:*",
+                    stats_interval=0.05)
+    thread = threading.Thread(target=router.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield get_endpoint(router.frontend), get_endpoint(router.backend)
+
+    router.stop()
+    thread.join()
+    router.close()
+
+
+@pytest.fixture
+def channels(router):
+    # channels(cls, *identities, **kwargs) connects a channel of cls per
+    # identity to the router and waits for the subscriptions to get there
+    created = []
+
+    def create(cls, *identities, **kwargs):
+        new = [cls(identity, router[0], router[1], **kwargs)
+               for identity in identities]
+        created.extend(new)
+        time.sleep(0.2)
+
+        return new
+
+    yield create
+
+    for channel in created:
+        channel.context.destroy(linger=0)
+
+
+@pytest.fixture
+def spy(router):
+    # spy(identity) returns a function listing what was sent to identity
+    # so far as (frames, message) pairs
+    context = zmq.Context.instance()
+    sockets = []
+
+    def create(identity):
+        socket = context.socket(zmq.SUB)
+        socket.connect(router[1])
+        socket.setsockopt(zmq.SUBSCRIBE, (identity + "::").encode("utf-8"))
+        sockets.append(socket)
+        seen = []
+
+        def read():
+            while socket.poll(50):
+                frames = socket.recv_multipart()
+                seen.append((frames, decode_frames(identity, frames)))
+
+            return seen
+
+        time.sleep(0.2)
+
+        return read
+
+    yield create
+
+    for socket in sockets:
+        socket.close(linger=0)
+
+
+def decode_frames(identity, frames):
+    if len(frames) > 1:
+        return {'headers': decode(frames[1])}
+
+    return decode(frames[0][len(identity) + 2:])
+
+
+def wait_for(channels, condition, timeout=5):
+    # runs the channels until condition() holds
+    end = time.time() + timeout
+
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("timed out")
+
+        for channel in channels:
+            channel.run_once(0.01)
+
+
+@pytest.fixture
+def pump():
+    return wait_for
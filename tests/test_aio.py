@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from channel import (AsyncReliableChannel, AsyncRedisRetryScheduler,
+                     AsyncRedisDeadMessageBackend)
+
+
+def test_round_trip_and_stop(router):
+    async def run():
+        a = AsyncReliableChannel("a", router[0], router[1])
+        b = AsyncReliableChannel("b", router[0], router[1])
+        received = []
+        b.register_callback(received.append)
+
+        tasks = [asyncio.ensure_future(channel.run_forever()) for channel in (a, b)]
+        await asyncio.sleep(0.2)
+
+        await a.send("b", "hello")
+
+        deadline = time.time() + 5
+        while (not received or await a.message_cache.get_unconfirmed_messages()) \
+                and time.time() < deadline:
+            await asyncio.sleep(0.01)
+
+        assert [message['data'] for message in received] == ["hello"]
+        assert not await a.message_cache.get_unconfirmed_messages()
+        assert not a.sends
+
+        # nothing is due, stop() still ends the wait for messages
+        for channel in (a, b):
+            channel.stop()
+
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        a.context.destroy(linger=0)
+
+    asyncio.run(run())
+
+
+def test_retry_scheduler_flushes_and_loads():
+    async def run():
+        r = fakeredis.FakeAsyncRedis()
+        scheduler = AsyncRedisRetryScheduler(r, "retry")
+
+        scheduler.schedule("x", 10)
+        scheduler.schedule("y", 20)
+        scheduler.retry_later("y", 2, now=30)
+        scheduler.cancel("x")
+        await scheduler.flush()
+
+        assert scheduler.changed == set()
+        assert await r.zrange("retry", 0, -1) == [b"y"]
+
+        restarted = AsyncRedisRetryScheduler(r, "retry", jitter=0)
+        await restarted.load()
+
+        assert list(restarted.scheduled) == ["y"]
+        assert restarted.scheduled["y"][1] == 2
+        assert restarted.get_due(restarted.scheduled["y"][0]) == [("y", 2)]
+
+    asyncio.run(run())
+
+
+def test_dead_message_backend_buffers_until_flushed():
+    async def run():
+        r = fakeredis.FakeAsyncRedis()
+        backend = AsyncRedisDeadMessageBackend(r, "dead")
+
+        backend.store("x", {"class": "SEND"}, "Retry attempts exceeded")
+        backend.store("y", {"class": "RECEIVE"}, "Acknoweledge time expired")
+        assert not await r.exists("dead")
+
+        await backend.flush()
+        selected = await backend.select(lambda details: details["data"]["class"] == "SEND")
+        assert [details["context"] for details in selected] == ["x"]
+
+        await backend.remove_many(["x"])
+        assert [details["context"] async for details in backend.iter_messages()] == ["y"]
+
+    asyncio.run(run())
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from channel import (OrderedMemoryMessageCache, OrderedRedisMessageCache,
+                     WindowedDeduplicator)
+
+
+def get_message(message_id, timestamp, status='SYN'):
+    return {
+        'class': 'SEND',
+        'message': message_id,
+        'destination': 'b',
+        'headers': {'message_id': message_id},
+        'status': status,
+        'timestamp': timestamp
+    }
+
+
+def test_memory_cache_forgets_acknowledged_received_messages():
+    cache = OrderedMemoryMessageCache(WindowedDeduplicator())
+    cache.mark_as_received("a", get_message("a", 1))
+
+    assert [m['headers']['message_id'] for m in cache.get_received_syn_messages()] == ["a"]
+
+    cache.mark_as_received("a", get_message("a", 1, status='ACK'))
+
+    assert cache.get_received_syn_messages() == []
+    assert cache.is_already_received("a")
+
+
+def test_ordered_redis_cache_pages_in_timestamp_order():
+    fakeredis = pytest.importorskip("fakeredis")
+    cache = OrderedRedisMessageCache(fakeredis.FakeStrictRedis(), "sent",
+                                     "received", page_size=2)
+
+    for index, message_id in enumerate("cabde"):
+        cache.store_message_to_send(message_id, get_message(message_id, 10 - index))
+
+    cache.confirm_many(["b"])
+
+    ids = [m['headers']['message_id'] for m in cache.iter_unconfirmed_messages()]
+    assert ids == ["e", "d", "a", "c"]
+
+
+def test_ordered_redis_cache_migrates_legacy_lists():
+    fakeredis = pytest.importorskip("fakeredis")
+    r = fakeredis.FakeStrictRedis()
+
+    # the layout of versions keeping ids in lists
+    for message_id, timestamp in (("b", 2), ("a", 1), ("gone", 3)):
+        r.rpush("sent_keys", message_id)
+    for message_id, timestamp in (("b", 2), ("a", 1)):
+        r.hset("sent", message_id, json.dumps(get_message(message_id, timestamp)))
+
+    cache = OrderedRedisMessageCache(r, "sent", "received", page_size=2)
+
+    ids = [m['headers']['message_id'] for m in cache.iter_unconfirmed_messages()]
+    assert ids == ["a", "b"]
+    assert not r.exists("sent_keys")
+
+    cache.confirm_many(["a"])
+
+    assert [m['headers']['message_id'] for m in cache.get_unconfirmed_messages()] == ["b"]
@@ -0,0 +1,61 @@
+import zmq
+
+from channel import Dispatcher, JsonChannel
+from channel.cluster import run_worker
+from channel.codec import decode_headers
+
+
+class Frames(object):
+    # what a channel sends, as the frames a dispatcher receives
+
+    def __init__(self):
+        self.frames = None
+
+    def send(self, data, *args, **kwargs):
+        self.frames = [zmq.Frame(data)]
+
+    def send_multipart(self, frames, *args, **kwargs):
+        self.frames = [zmq.Frame(getattr(frame, 'bytes', frame)) for frame in frames]
+
+
+def test_only_the_headers_are_decoded():
+    body = b'{"headers":{"source":"x"},"data":not json'
+    assert decode_headers(body) == {"source": "x"}
+
+
+def test_dispatcher_reads_the_source_of_both_framings(router):
+    dispatcher = Dispatcher("srv", router[1], [])
+
+    for multipart in (True, False):
+        channel = JsonChannel("client", router[0], router[1], multipart=multipart)
+        captured = channel.sender = Frames()
+        channel.senders = dict.fromkeys(channel.senders, captured)
+
+        channel.send("srv", {"text": "hello"})
+        assert dispatcher.get_source(captured.frames) == "client"
+
+        channel.context.destroy(linger=0)
+
+    dispatcher.close()
+
+
+def test_worker_ticks_without_traffic(router):
+    created = []
+    ticks = []
+
+    def create(identity, publish_to, receive_from):
+        channel = JsonChannel(identity, publish_to, receive_from)
+        created.append(channel)
+        return channel
+
+    def tick(channel):
+        ticks.append(channel.identity)
+
+        if len(ticks) == 3:
+            channel.stop()
+
+    run_worker("srv.0", router[0], router[1], "tcp://127.0.0.1:1", create,
+               tick, tick_interval=0.02)
+
+    assert ticks == ["srv.0"] * 3
+    created[0].context.destroy(linger=0)
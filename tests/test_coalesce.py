@@ -0,0 +1,80 @@
+import pytest
+
+from channel import Coalescer, ReliableChannel
+from channel.coalesce import unpack
+
+
+def test_envelopes_fill_up_or_wait_out_their_linger():
+    coalescer = Coalescer(max_messages=3, linger=10)
+
+    assert coalescer.add("b", 1, now=100) is None
+    assert coalescer.add("c", 2, now=100.005) is None
+    assert coalescer.add("b", 3, {'type': "x"}, now=100.006) is None
+    assert coalescer.add("b", 4, now=100.007) == [
+        {'data': 1}, {'data': 3, 'headers': {'type': "x"}}, {'data': 4}]
+
+    assert coalescer.get_next_deadline() == pytest.approx(100.015)
+    assert coalescer.get_due(now=100.012) == []
+    assert coalescer.get_due(now=100.016) == [("c", [{'data': 2}])]
+
+
+def test_unpacked_messages_share_the_envelope_headers():
+    envelope = {
+        'headers': {'message_id': "m", 'source': "a", 'batch': True},
+        'data': [{'data': 1}, {'data': 2, 'headers': {'type': "x"}}]
+    }
+    single = {'headers': {'message_id': "n"}, 'data': 3}
+
+    assert unpack([envelope, single]) == [
+        {'headers': {'message_id': "m", 'source': "a", 'batch_index': 0},
+         'data': 1},
+        {'headers': {'message_id': "m", 'source': "a", 'batch_index': 1,
+                     'type': "x"},
+         'data': 2},
+        single]
+
+
+def test_coalesced_sends_arrive_in_order(channels, spy, pump):
+    a, = channels(ReliableChannel, "a",
+                  coalescer=Coalescer(max_messages=3, linger=20))
+    b, = channels(ReliableChannel, "b")
+    to_b = spy("b")
+    received = []
+    b.register_callback(received.append)
+
+    # b lists batch in its ack of the first message
+    for index in range(6):
+        a.send("b", index)
+
+        if index == 0:
+            pump([a, b], lambda: not a.message_cache.get_unconfirmed_messages())
+
+    pump([a, b], lambda: len(received) == 6
+         and not a.message_cache.get_unconfirmed_messages())
+
+    # one full envelope and one sent once its linger was up
+    assert [message['data'] for message in received] == list(range(6))
+    assert [bool(message['headers'].get('batch'))
+            for _, message in to_b()] == [False, True, True]
+
+
+def test_peers_without_batch_get_every_message_alone(channels, spy, pump):
+    class OldChannel(ReliableChannel):
+        def get_accept(self):
+            return [name for name in super(OldChannel, self).get_accept()
+                    if name != 'batch']
+
+    a, = channels(ReliableChannel, "a",
+                  coalescer=Coalescer(max_messages=3, linger=20))
+    b, = channels(OldChannel, "b")
+    to_b = spy("b")
+    received = []
+    b.register_callback(received.append)
+
+    for index in range(4):
+        a.send("b", index)
+        pump([a, b], lambda: len(received) == index + 1
+             and not a.message_cache.get_unconfirmed_messages())
+
+    assert [message['data'] for message in received] == list(range(4))
+    assert not any(message['headers'].get('batch') for _, message in to_b())
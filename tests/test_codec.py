@@ -0,0 +1,129 @@
+import json
+import time
+
+import pytest
+import zmq
+
+from channel import Channel, MsgpackCodec, ReliableChannel
+
+
+def test_multipart_only_once_the_peer_listed_it(channels, spy, pump):
+    a, b = channels(ReliableChannel, "a", "b")
+    to_b = spy("b")
+    received = []
+    b.register_callback(received.append)
+
+    for index in range(2):
+        a.send("b", index)
+        pump([a, b], lambda: len(received) == index + 1
+             and not a.message_cache.get_unconfirmed_messages())
+
+    assert [message['data'] for message in received] == [0, 1]
+
+    sent = [(len(frames), message['headers']) for frames, message in to_b()]
+    assert [count for count, _ in sent] == [1, 3]
+    assert 'multipart' in sent[0][1]['accept']
+    # a saw b use multipart, it knows b read its accept
+    assert 'accept' not in sent[1][1]
+
+
+def test_old_peers_get_single_frames(router, channels, spy, pump):
+    b, = channels(ReliableChannel, "b")
+    to_old = spy("old")
+
+    sender = zmq.Context.instance().socket(zmq.PUB)
+    sender.connect(router[0])
+    time.sleep(0.2)
+
+    sender.send(b"b::" + json.dumps({
+        "headers": {"message_id": "x", "source": "old", "destination": "b"},
+        "data": "x"
+    }).encode("utf-8"))
+
+    pump([b], lambda: to_old())
+    sender.close(linger=0)
+
+    assert all(len(frames) == 1 for frames, _ in to_old())
+
+
+def test_compressed_only_for_peers_that_listed_zlib(channels, spy, pump):
+    a, b = channels(ReliableChannel, "a", "b", compress_threshold=10)
+    to_b = spy("b")
+    received = []
+    b.register_callback(received.append)
+
+    for index in range(2):
+        a.send("b", "x" * 100)
+        pump([a, b], lambda: len(received) == index + 1
+             and not a.message_cache.get_unconfirmed_messages())
+
+    assert [message['data'] for message in received] == ["x" * 100] * 2
+
+    encodings = [message['headers'].get('encoding') for _, message in to_b()]
+    assert encodings == [None, 'zlib']
+
+
+def test_retransmits_reuse_the_encoded_payload(channels):
+    a, = channels(ReliableChannel, "a", compress_threshold=10)
+    a.peer_accepts["b"] = set(['multipart', 'zlib'])
+    headers = {'message_id': "m"}
+
+    first = a.encode_payload("b", a.codec, "x" * 100, headers)
+    assert first[1]
+    assert a.encode_payload("b", a.codec, "x" * 100, headers)[0] is first[0]
+
+    a.handle_acknowledged(["m"])
+    assert not a.payloads
+
+
+def test_msgpack_only_once_the_peer_listed_it(channels, spy, pump):
+    pytest.importorskip("msgpack")
+
+    a, b = channels(ReliableChannel, "a", "b", codec=MsgpackCodec())
+    c, = channels(ReliableChannel, "c")
+    to_b, to_c = spy("b"), spy("c")
+    received = []
+    b.register_callback(received.append)
+    c.register_callback(received.append)
+
+    for index in range(2):
+        a.send("b", index)
+        a.send("c", index)
+        pump([a, b, c], lambda: len(received) == 2 * (index + 1)
+             and not a.message_cache.get_unconfirmed_messages())
+
+    assert sorted(message['data'] for message in received) == [0, 0, 1, 1]
+
+    # b listed msgpack in its ack, c only ever gets JSON
+    assert [is_json(frames) for frames, _ in to_b()] == [True, False]
+    assert [is_json(frames) for frames, _ in to_c()] == [True, True]
+
+
+def is_json(frames):
+    # the headers frame, or the body after the b:: or c:: topic
+    if len(frames) > 1:
+        return frames[1][:1] == b"{"
+
+    return frames[0][3:4] == b"{"
+
+
+def test_window_bytes_are_measured_with_the_codec(channels):
+    pytest.importorskip("msgpack")
+
+    a, = channels(ReliableChannel, "a", codec=MsgpackCodec(), window_bytes=100)
+
+    a.send("b", b"\x00binary")
+
+    assert a.get_window("b").in_flight_bytes == len(a.codec.encode(b"\x00binary"))
+
+
+def test_plain_channels_send_anything_that_formats(channels, pump):
+    a, b = channels(Channel, "a", "b")
+    received = []
+    b.register_callback(received.append)
+
+    a.send("b", 5)
+    a.send("b", u"caf\xe9")
+    pump([b], lambda: len(received) == 2)
+
+    assert received == [u"5", u"caf\xe9"]
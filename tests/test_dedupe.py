@@ -0,0 +1,31 @@
+import time
+
+from channel import WindowedDeduplicator, BloomDeduplicator
+
+
+def test_windowed_forgets_oldest_over_max_size():
+    deduplicator = WindowedDeduplicator(max_size=2)
+    deduplicator.add_many(["a", "b", "c"])
+
+    assert deduplicator.are_duplicates(["a", "b", "c"]) == [False, True, True]
+
+
+def test_windowed_expires_ids_on_lookup():
+    deduplicator = WindowedDeduplicator(window=0.05)
+    deduplicator.add("a")
+
+    assert deduplicator.is_duplicate("a")
+
+    time.sleep(0.1)
+
+    # nothing was added since, the lookup alone evicts it
+    assert not deduplicator.is_duplicate("a")
+    assert not deduplicator.message_ids
+
+
+def test_bloom_remembers_recent_ids():
+    deduplicator = BloomDeduplicator(capacity=100)
+    deduplicator.add_many(str(i) for i in range(150))
+
+    assert all(deduplicator.are_duplicates([str(i) for i in range(100, 150)]))
+    assert not deduplicator.is_duplicate("missing")
@@ -0,0 +1,61 @@
+import threading
+
+from channel import KeyedExecutor, ReliableChannel
+
+
+def test_replies_from_workers_go_out_without_new_messages(channels, pump):
+    a, b = channels(ReliableChannel, "a", "b")
+    executor = KeyedExecutor(workers=2)
+    b.set_executor(executor)
+
+    def reply(message):
+        b.send(message['headers']['source'], message['data'] + 1)
+
+    b.register_callback(reply)
+
+    replies = []
+    a.register_callback(replies.append)
+
+    # b waits for messages with no timeout, only its wake up socket tells
+    # it there is a reply to send
+    thread = threading.Thread(target=b.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    a.send("b", 1)
+    pump([a], lambda: replies, timeout=3)
+
+    assert [message['data'] for message in replies] == [2]
+
+    b.stop()
+    b.wake()
+    thread.join(1)
+    executor.shutdown()
+
+
+def test_blocked_workers_give_up_waiting_for_room(channels, pump):
+    a, = channels(ReliableChannel, "a")
+    b, = channels(ReliableChannel, "b", window_size=1, flow_control='block',
+                  block_timeout=0.05)
+    # one worker with room for one task, the receiving thread waits on it
+    # while it waits for a window nobody opens
+    executor = KeyedExecutor(workers=1, max_queue=1)
+    b.set_executor(executor)
+    handled = []
+
+    def forward(message):
+        b.send("nobody", message['data'])
+        handled.append(message['data'])
+
+    b.register_callback(forward)
+
+    for index in range(4):
+        a.send("b", index)
+
+    pump([a, b], lambda: len(handled) == 4)
+
+    window = b.get_window("nobody")
+    assert len(window.in_flight) == 1
+    assert len(window.queue) == 3
+
+    executor.shutdown()
@@ -0,0 +1,56 @@
+from channel import ReliableChannel
+from channel.flow import FlowWindow
+
+
+def test_queued_messages_drain_in_order():
+    window = FlowWindow(max_messages=2)
+
+    for message_id in ("a", "b"):
+        window.acquire(message_id, 0, 0)
+
+    window.enqueue("c", 0)
+    window.enqueue("d", 0)
+    assert not window.is_open()
+
+    window.release("a", 1)
+    assert window.drain(1) == ["c"]
+    assert not window.has_room()
+
+
+def test_byte_only_window():
+    window = FlowWindow(max_messages=0, max_bytes=100)
+
+    window.acquire("a", 60, 0)
+    assert window.has_room(40)
+    assert not window.has_room(41)
+
+    for index in range(100):
+        window.acquire(index, 0, 0)
+
+    assert window.has_room(40)
+
+
+def test_retransmitted_messages_give_no_rtt_sample():
+    window = FlowWindow(max_messages=8)
+
+    window.acquire("a", 0, 0)
+    window.release("a", 1)
+    assert window.rtt == 1
+
+    window.acquire("b", 0, 1)
+    window.retransmit("b")
+    window.release("b", 100)
+    assert window.rtt == 1
+    assert window.size == 8
+
+
+def test_window_bytes_alone_limits_the_channel(channels):
+    a, = channels(ReliableChannel, "a", window_bytes=1)
+
+    a.send("b", "first")
+    a.send("b", "second")
+
+    window = a.get_window("b")
+    assert window is not None
+    assert len(window.in_flight) == 1
+    assert len(window.queue) == 1
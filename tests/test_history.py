@@ -0,0 +1,45 @@
+from channel import HistoryClient, MemoryHistoryStore, get_history_reply
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, destination, message_data, extra_headers=None):
+        self.sent.append((destination, message_data, extra_headers))
+
+
+def test_own_sequences_move_the_client_past_its_messages():
+    client = HistoryClient(Recorder(), "srv", "srv")
+
+    # others' messages, then the sequence of our own, as the server sends
+    # them
+    assert client.is_new(1)
+    assert client.is_new(3)
+    assert client.last_sequence == 1
+
+    client.is_new(2)
+
+    assert client.last_sequence == 3
+    assert not client.seen
+
+
+def test_history_is_fetched_a_page_at_a_time():
+    store = MemoryHistoryStore()
+    for index in range(5):
+        store.append("srv", {"author": "a", "data": index})
+
+    channel = Recorder()
+    client = HistoryClient(channel, "srv", "srv", page_size=2)
+    shown = []
+
+    client.request()
+
+    while channel.sent:
+        _, _, headers = channel.sent.pop(0)
+        reply = get_history_reply(store, {"headers": headers})
+        shown.extend(entry["data"] for entry in client.handle({"data": reply}))
+
+    assert shown == [0, 1, 2, 3, 4]
+    assert client.last_sequence == 5
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from channel import ChannelHub, ReliableChannel, RetryScheduler
+
+
+def test_hosted_channels_talk_to_plain_ones(router, channels, pump):
+    hub = ChannelHub(router[0], router[1])
+    hosted = [hub.create_channel(identity) for identity in ("h1", "h2")]
+    x, = channels(ReliableChannel, "x")
+
+    for channel in hosted:
+        channel.register_callback(
+            lambda message, channel=channel: channel.send(
+                message['headers']['source'], channel.identity))
+
+    replies = []
+    x.register_callback(replies.append)
+
+    x.send("h1", 1)
+    x.send("h2", 2)
+    pump([x, hub], lambda: len(replies) == 2 and not (
+        x.message_cache.get_unconfirmed_messages() or
+        any(channel.message_cache.get_unconfirmed_messages()
+            for channel in hosted)))
+
+    assert sorted(message['data'] for message in replies) == ["h1", "h2"]
+
+    hub.close()
+
+
+def test_only_channels_that_changed_are_asked_for_deadlines(router):
+    hub = ChannelHub(router[0], router[1])
+    asked = []
+
+    class CountingChannel(ReliableChannel):
+        def get_next_deadline(self):
+            asked.append(self.identity)
+            return super(CountingChannel, self).get_next_deadline()
+
+    hub.channel_factory = CountingChannel
+    hosted = [hub.create_channel("h%d" % index,
+                                 retry_scheduler=RetryScheduler(initial_rto=30))
+              for index in range(50)]
+
+    # the first pass loads what each channel left unconfirmed, the second
+    # reads their deadlines after that
+    hub.run_once(0)
+    hub.run_once(0)
+    del asked[:]
+
+    hosted[7].send("nobody", "hello")
+
+    for _ in range(5):
+        hub.run_once(0)
+
+    # the send marks its channel, the others are left alone, and the retry
+    # 30 seconds out is the hub's next deadline
+    assert set(asked) == set(["h7"])
+    assert hub.get_next_deadline() > time.time() + 20
+
+    hub.close()
+
+
+def test_sends_from_other_threads_wake_the_hub(router):
+    hub = ChannelHub(router[0], router[1])
+    channel = hub.create_channel(
+        "h", retry_scheduler=RetryScheduler(initial_rto=0.05, jitter=0,
+                                            max_attempts=1))
+    dead = []
+    channel.dead_message_backend.store = lambda *args: dead.append(args)
+
+    # with nothing due the hub waits on its sockets without a timeout, only
+    # the wake up lets it see the retry the send scheduled
+    thread = threading.Thread(target=hub.run_forever)
+    thread.daemon = True
+    thread.start()
+    time.sleep(0.1)
+
+    channel.send("nobody", "hello")
+
+    end = time.time() + 3
+    while not dead and time.time() < end:
+        time.sleep(0.01)
+
+    hub.stop()
+    channel.wake()
+    thread.join(1)
+
+    assert len(dead) == 1
+    assert not thread.is_alive()
+
+    hub.close()
@@ -0,0 +1,53 @@
+from channel import OrderedMemoryMessageCache, ReliableChannel
+
+
+def test_group_message_confirmed_once_every_member_acked(channels, pump):
+    a, b, c = channels(ReliableChannel, "a", "b", "c")
+
+    for channel in (b, c):
+        channel.join("g")
+
+    a.send_to_group("g", ["b", "c"], "hello")
+
+    pump([a, b, c], lambda: not a.message_cache.get_unconfirmed_messages())
+    assert not a.multicasts
+
+
+def test_acked_members_survive_a_restart(channels, pump):
+    cache = OrderedMemoryMessageCache()
+    a, = channels(ReliableChannel, "a", message_cache=cache)
+    b, c = channels(ReliableChannel, "b", "c")
+
+    for channel in (b, c):
+        channel.join("g")
+
+    # d never acks
+    a.send_to_group("g", ["b", "c", "d"], "hello")
+
+    def stored_acks():
+        messages = cache.get_unconfirmed_messages()
+        return messages and sorted(messages[0].get('acked_members', [])) == ["b", "c"]
+
+    pump([a, b, c], stored_acks)
+
+    restarted, = channels(ReliableChannel, "a2", message_cache=cache)
+    restarted.load_unconfirmed_messages()
+
+    message_id = cache.get_unconfirmed_messages()[0]['headers']['message_id']
+    assert restarted.get_pending_members(message_id) == ["d"]
+    assert restarted.get_resend_destinations(cache.get_unconfirmed_messages()[0]) == ["d"]
+
+
+def test_dropped_destinations_return_only_catch_up_messages(channels):
+    a, = channels(ReliableChannel, "a")
+
+    a.send("gone", "hello")
+    a.send("gone", {"entries": []}, extra_headers={"type": "HISTORY"})
+    a.send_to_group("g", ["gone", "b"], "everyone")
+
+    dropped = a.drop_destination("gone")
+
+    assert sorted(message['message'] for message in dropped) == ["everyone", "hello"]
+
+    group_message, = a.message_cache.get_unconfirmed_messages()
+    assert a.get_pending_members(group_message['headers']['message_id']) == ["b"]
@@ -0,0 +1,133 @@
+import json
+import re
+import time
+
+import zmq
+
+from channel import ReliableChannel, RetryScheduler
+
+
+def get_acks(seen):
+    return [message for _, message in seen
+            if message['headers'].get('type') == 'ACK']
+
+
+def test_round_trip_with_compact_acks(channels, spy, pump):
+    a, b = channels(ReliableChannel, "a", "b")
+    to_a = spy("a")
+    received = []
+    b.register_callback(received.append)
+
+    for index in range(3):
+        a.send("b", index)
+
+    pump([a, b], lambda: len(received) == 3
+         and not a.message_cache.get_unconfirmed_messages())
+
+    assert [message['data'] for message in received] == [0, 1, 2]
+
+    acks = get_acks(to_a())
+    assert acks and all('message_ids' in ack['headers'] for ack in acks)
+
+
+def test_peers_without_ack_batch_get_an_ack_per_message(router, channels,
+                                                        spy, pump):
+    b, = channels(ReliableChannel, "b")
+    to_old = spy("old")
+
+    # a peer from before compact acks, reading headers['message_id']
+    sender = zmq.Context.instance().socket(zmq.PUB)
+    sender.connect(router[0])
+    time.sleep(0.2)
+
+    for message_id in ("x", "y"):
+        sender.send(b"b::" + json.dumps({
+            "headers": {"message_id": message_id, "source": "old",
+                        "destination": "b"},
+            "data": message_id
+        }).encode("utf-8"))
+
+    pump([b], lambda: len(get_acks(to_old())) >= 2)
+    sender.close(linger=0)
+
+    acks = get_acks(to_old())
+    assert sorted(ack['headers']['message_id'] for ack in acks) == ["x", "y"]
+    assert not any('message_ids' in ack['headers'] for ack in acks)
+
+
+class DroppingSocket(object):
+    # drops the first message to match, e.g. a lost sequence
+
+    def __init__(self, socket, pattern):
+        self.socket = socket
+        self.pattern = pattern
+        self.dropped = False
+
+    def drop(self, frames):
+        if self.dropped or not any(re.search(self.pattern, frame) for frame in frames):
+            return False
+
+        self.dropped = True
+        return True
+
+    def send(self, data, *args, **kwargs):
+        if not self.drop([data]):
+            return self.socket.send(data, *args, **kwargs)
+
+    def send_multipart(self, frames, *args, **kwargs):
+        if not self.drop([getattr(frame, 'bytes', frame) for frame in frames]):
+            return self.socket.send_multipart(frames, *args, **kwargs)
+
+
+def test_gaps_are_recovered_by_nack(channels, pump):
+    a, = channels(ReliableChannel, "a", sequenced=True,
+                  retry_scheduler=RetryScheduler(initial_rto=30))
+    b, = channels(ReliableChannel, "b", nack_interval=0.05)
+    received = []
+    b.register_callback(received.append)
+
+    dropping = DroppingSocket(a.sender, br'"sequence":2[,}]')
+    a.senders[next(iter(a.shards))] = dropping
+
+    for index in range(3):
+        a.send("b", index)
+
+    # the timeout would only resend after 30 seconds
+    pump([a, b], lambda: len(received) == 3, timeout=3)
+
+    assert dropping.dropped
+    assert sorted(message['data'] for message in received) == [0, 1, 2]
+
+
+def test_gaps_the_sender_cannot_fill_are_given_up(channels, pump):
+    a, = channels(ReliableChannel, "a", sequenced=True,
+                  retry_scheduler=RetryScheduler(initial_rto=30))
+    b, = channels(ReliableChannel, "b", nack_interval=0.02, max_nacks=3)
+    received = []
+    b.register_callback(received.append)
+
+    dropping = DroppingSocket(a.sender, br'"sequence":2[,}]')
+    a.senders[next(iter(a.shards))] = dropping
+
+    for index in range(3):
+        a.send("b", index)
+
+    # as if the lost message went dead on a, its NACKs go unanswered
+    a.forget_sequence(a.outstanding["b"][2])
+
+    pump([a, b], lambda: len(received) == 2
+         and not b.sequence_trackers["a"].has_gaps(), timeout=3)
+
+    assert b.sequence_trackers["a"].next_sequence == 4
+    assert b.get_next_deadline() is None or b.get_next_deadline() > time.time() + 1
+
+
+def test_unsequenced_peers_are_not_tracked(channels, pump):
+    a, b = channels(ReliableChannel, "a", "b")
+    received = []
+    b.register_callback(received.append)
+
+    a.send("b", "hello")
+    pump([a, b], lambda: received)
+
+    assert not b.sequence_trackers
@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+from channel import MemoryDeadMessageBackend, ReliableChannel, RetryScheduler
+
+
+def get_contexts(backend):
+    return [details['context'] for details in backend.iter_messages()]
+
+
+def test_replays_stay_dead_until_stored_again(channels, pump):
+    dead = MemoryDeadMessageBackend()
+    a, = channels(ReliableChannel, "a", dead_message_backend=dead,
+                  retry_scheduler=RetryScheduler(initial_rto=0.01, max_attempts=1))
+
+    a.send("nobody", "hello")
+    pump([a], lambda: get_contexts(dead))
+    message_id, = get_contexts(dead)
+    assert not a.message_cache.get_unconfirmed_messages()
+
+    assert a.replay_dead_messages() == 1
+    # queued ones aren't picked twice, and a crash now loses nothing
+    assert a.replay_dead_messages() == 0
+    assert get_contexts(dead) == [message_id]
+
+    a.replay_due_messages(time.time())
+
+    assert not get_contexts(dead)
+    assert not a.replay_contexts
+    replayed, = a.message_cache.get_unconfirmed_messages()
+    assert replayed['headers']['message_id'] == message_id
+    assert replayed['message'] == "hello"
+
+
+def test_replay_rate_must_be_positive(router):
+    with pytest.raises(ValueError):
+        ReliableChannel("a", router[0], router[1], replay_rate=0)
+
+
+def test_slow_replay_rates_still_drain(channels):
+    a, = channels(ReliableChannel, "a", replay_rate=0.5)
+    a.replay_queue.extend({'context': index} for index in range(3))
+
+    now = 1000
+    due = len(a.get_due_replays(now))
+
+    for _ in range(3):
+        now += 2
+        due += len(a.get_due_replays(now))
+
+    assert due == 3
@@ -0,0 +1,39 @@
+import pytest
+
+from channel import RetryScheduler, RedisRetryScheduler
+
+
+def test_backoff_and_due_order():
+    scheduler = RetryScheduler(initial_rto=1, backoff=2, jitter=0)
+    scheduler.schedule_new(["a", "b"], deadline=10)
+
+    assert scheduler.get_next_deadline() == 10
+    assert scheduler.get_due(now=10) == [("a", 0), ("b", 0)]
+
+    scheduler.retry_many_later([("a", 1), ("b", 2)], now=10)
+
+    assert scheduler.get_due(now=11) == [("a", 1)]
+    assert scheduler.get_due(now=12) == [("b", 2)]
+
+
+def test_cancelled_entries_are_skipped():
+    scheduler = RetryScheduler()
+    scheduler.schedule_new(["a", "b"], deadline=1)
+    scheduler.cancel("a")
+
+    assert scheduler.get_due(now=2) == [("b", 0)]
+    assert scheduler.get_next_deadline() is None
+
+
+def test_redis_scheduler_returns_text_ids():
+    fakeredis = pytest.importorskip("fakeredis")
+    scheduler = RedisRetryScheduler(fakeredis.FakeStrictRedis(), "retries",
+                                    jitter=0)
+    scheduler.schedule_new(["abc"], deadline=1)
+
+    assert scheduler.get_due(now=2) == [("abc", 0)]
+
+    scheduler.retry_many_later([("abc", 1)], now=2)
+
+    assert scheduler.get_due(now=2) == []
+    assert scheduler.get_due(now=3) == [("abc", 1)]
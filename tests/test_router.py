@@ -0,0 +1,43 @@
+import zmq
+
+from channel.router import Router
+
+
+def test_a_slow_subscriber_does_not_hold_up_the_others():
+    context = zmq.Context()
+    router = Router("inproc://frontend", "inproc://backend", hwm=10,
+                    stats_interval=60, context=context)
+
+    fast = context.socket(zmq.SUB)
+    fast.connect("inproc://backend")
+    fast.setsockopt(zmq.SUBSCRIBE, b"b::")
+
+    # never reads, it is full after a few messages
+    slow = context.socket(zmq.SUB)
+    slow.setsockopt(zmq.RCVHWM, 10)
+    slow.connect("inproc://backend")
+    slow.setsockopt(zmq.SUBSCRIBE, b"b::")
+
+    publisher = context.socket(zmq.PUB)
+    publisher.connect("inproc://frontend")
+
+    for _ in range(5):
+        router.run_once(0.01)
+
+    for index in range(100):
+        publisher.send(b"b::" + str(index).encode("utf-8"))
+
+    for _ in range(5):
+        router.run_once(0.01)
+
+    received = []
+    while fast.poll(10):
+        received.append(fast.recv())
+
+    # the slow subscriber's misses are counted
+    stats = router.report(0)
+    assert len(received) == 100
+    assert stats['messages'] == 100
+    assert 0 < stats['dropped'] < 100
+
+    context.destroy(linger=0)
@@ -0,0 +1,34 @@
+import pytest
+
+from channel import Channel, HashRing
+from channel.shard import get_shards
+
+
+def test_single_locations_and_lists_mix():
+    assert list(get_shards(["tcp://a:1"], "tcp://a:2").items()) == [("tcp://a:1", "tcp://a:2")]
+    assert list(get_shards("tcp://a:1", ("tcp://a:2",)).items()) == [("tcp://a:1", "tcp://a:2")]
+
+
+def test_shard_counts_must_match():
+    with pytest.raises(ValueError):
+        get_shards(["tcp://a:1", "tcp://b:1"], "tcp://a:2")
+
+
+def test_channel_takes_a_list_and_a_location(router):
+    channel = Channel("a", [router[0]], router[1])
+
+    assert list(channel.shards.items()) == [(router[0], router[1])]
+    assert channel.receive_from == set([router[1]])
+
+    channel.context.destroy(linger=0)
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = HashRing(["a", "b", "c"])
+    before = dict((str(key), ring.get_node(str(key))) for key in range(1000))
+
+    ring.remove_node("c")
+
+    for key, node in before.items():
+        if node != "c":
+            assert ring.get_node(key) == node